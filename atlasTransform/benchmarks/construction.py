@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Workflow construction benchmark
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+
+Times init_base_wf (and pickling the result) on synthetic cohorts of increasing size.
+Every run is a hard link to one small 3D image on the MNI 2mm grid, so building the
+cohort costs almost nothing and only construction is measured. Each size runs in a fresh
+process so the peak memory numbers do not carry over.
+
+    python -m atlasTransform.benchmarks.construction --subjects 100 1000 10000
+"""
+import json
+import os
+import pickle
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import SUPPRESS, ArgumentParser
+from pathlib import Path
+
+import nibabel
+import numpy
+
+from .synthetic import MNI_2MM_AFFINE
+
+
+def make_synthetic_cohort(root, n_subjects: int, runs_per_subject: int = 1) -> dict:
+    """
+    :return: subject label -> {'hurst': [run files]}, like utils.bids.collect_data
+    """
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    template = root / 'template_hurst.nii.gz'
+    if not template.exists():
+        nibabel.Nifti1Image(numpy.zeros((91, 109, 91), dtype=numpy.float32), MNI_2MM_AFFINE).to_filename(
+            str(template))
+    subject_data = {}
+    for subject in range(n_subjects):
+        label = '%05d' % subject
+        func = root / ('sub-' + label) / 'func'
+        func.mkdir(parents=True, exist_ok=True)
+        runs = []
+        for run in range(1, runs_per_subject + 1):
+            run_file = func / ('sub-%s_task-rest_run-%d_hurst.nii.gz' % (label, run))
+            if not run_file.exists():
+                os.link(str(template), str(run_file))
+            runs.append(str(run_file))
+        subject_data[label] = {'hurst': runs}
+    return subject_data
+
+
+def measure(n_subjects: int, runs_per_subject: int, atlases: list, extra_args: list, root) -> dict:
+    from ..cli.run_utils import get_parser
+    from ..workflows.base import init_base_wf
+
+    bids_dir = Path(root) / 'bids'
+    subject_data = make_synthetic_cohort(bids_dir, n_subjects, runs_per_subject)
+    opts = get_parser().parse_args([str(bids_dir), str(Path(root) / 'out'), 'participant'] + atlases +
+                                   ['--source', 'hurst', '--resolution', '2', '-w', str(Path(root) / 'work')] +
+                                   extra_args)
+
+    start = time.perf_counter()
+    workflow = init_base_wf(opts=opts, layout=None, run_uuid='benchmark', subject_list=list(subject_data),
+                            work_dir=str(opts.work_dir), output_dir=str(opts.output_dir), subject_data=subject_data)
+    construction = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pickled = len(pickle.dumps(workflow, protocol=pickle.HIGHEST_PROTOCOL))
+    pickling = time.perf_counter() - start
+
+    return dict(
+        subjects=n_subjects,
+        runs=n_subjects * runs_per_subject,
+        nodes=len(workflow.list_node_names()),
+        construction_s=construction,
+        construction_per_subject_ms=1000 * construction / n_subjects,
+        pickling_s=pickling,
+        pickle_mb=pickled / 1024 ** 2,
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    )
+
+
+def get_parser():
+    parser = ArgumentParser(description='time workflow construction on synthetic cohorts')
+    parser.add_argument('--subjects', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='cohort sizes')
+    parser.add_argument('--runs-per-subject', type=int, default=1)
+    parser.add_argument('--atlases', nargs='+', default=['shen'])
+    parser.add_argument('--work-root', default=None,
+                        help='where the synthetic cohorts are created (a temporary folder if not given)')
+    parser.add_argument('--output', default=None, help='write the results to this json file')
+    parser.add_argument('--single', action='store_true', help=SUPPRESS)
+    return parser
+
+
+def main(argv=None):
+    opts, extra_args = get_parser().parse_known_args(argv)
+    if opts.single:
+        result = measure(opts.subjects[0], opts.runs_per_subject, opts.atlases, extra_args, opts.work_root)
+        print(json.dumps(result))
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_subjects in opts.subjects:
+            root = Path(opts.work_root or tmp) / ('cohort_%d' % n_subjects)
+            root.mkdir(parents=True, exist_ok=True)
+            output = subprocess.run(
+                [sys.executable, '-m', 'atlasTransform.benchmarks.construction', '--single', '--subjects', str(n_subjects),
+                 '--runs-per-subject', str(opts.runs_per_subject), '--atlases'] + opts.atlases +
+                ['--work-root', str(root)] + extra_args,
+                check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+            print('%(subjects)6d subjects: %(construction_s)8.2fs (%(construction_per_subject_ms).2f ms/subject), '
+                  'pickle %(pickling_s).2fs / %(pickle_mb).1fMB, peak rss %(peak_rss_mb).0fMB' % results[-1],
+                  file=sys.stderr)
+
+    if opts.output:
+        with open(opts.output, 'w') as fobj:
+            json.dump(results, fobj, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Extraction benchmark
+^^^^^^^^^^^^^^^^^^^^
+
+Times AtlasTransform on a synthetic 4D bold series and a 3D hurst map (see benchmarks.synthetic)
+for every atlas case, extraction engine and output format, and writes the results as JSON so
+runs of different versions can be compared:
+
+    python -m atlasTransform.benchmarks.extraction --output results.json
+    python -m atlasTransform.benchmarks.extraction --output new.json --compare results.json
+
+Every case is timed once cold (new interface: atlas loading, resampling and indexing included)
+and --repeat times warm (the interface and its atlas indices reused, as by a batched node or a
+direct engine worker). Output formats are timed on the roi data of each case. Nothing is
+downloaded, the atlases ship with the package.
+"""
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+from argparse import ArgumentParser
+from multiprocessing import cpu_count
+from pathlib import Path
+
+import nibabel
+
+from ..utils.constants import EXTRACTION_ENGINES, OUTPUT_EXTENSIONS, OUTPUT_FORMATS
+from .synthetic import GRIDS, make_synthetic_dataset
+
+DEFAULT_CRADDOCK_SIZES = [10, 200, 950]
+
+
+def atlas_cases(craddock_sizes: list) -> dict:
+    """case name -> AtlasTransform inputs"""
+    cases = {
+        'shen_1mm': dict(atlas_name='shen', resolution=1),
+        'shen_2mm': dict(atlas_name='shen', resolution=2),
+    }
+    for number_of_clusters in craddock_sizes:
+        cases['craddock_%d' % number_of_clusters] = dict(atlas_name='craddock', number_of_clusters=number_of_clusters)
+    cases['craddock_all'] = dict(atlas_name='craddock', all_granularities=True)
+    cases['power'] = dict(atlas_name='power')
+    return cases
+
+
+def _interface(case_inputs: dict, engine: str, atlas_cache_dir: str, bids_dir: str):
+    from ..interfaces import AtlasTransform
+    inputs = dict(resolution=2, number_of_clusters=200, similarity_measure='t', algorithm='2level')
+    inputs.update(case_inputs)
+    return AtlasTransform(engine=engine, write_files=False, atlas_cache_dir=atlas_cache_dir, bids_dir=bids_dir,
+                          **inputs)
+
+
+def time_case(source: str, case_inputs: dict, engine: str, repeat: int, atlas_cache_dir: str, bids_dir: str) -> dict:
+    """:return: cold and warm wall times of extracting case_inputs from source with engine"""
+    interface = _interface(case_inputs, engine, atlas_cache_dir, bids_dir)
+    start = time.perf_counter()
+    interface._transform(source)
+    cold = time.perf_counter() - start
+    warm = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        interface._transform(source)
+        warm.append(time.perf_counter() - start)
+    return dict(cold_s=cold, warm_min_s=min(warm), warm_median_s=statistics.median(warm))
+
+
+def time_formats(roi_data, formats: list, repeat: int, tmp_dir: str) -> dict:
+    """:return: format -> write times and file size (or the reason it was skipped)"""
+    from ..utils.output import write_roi_data
+    results = {}
+    for output_format in formats:
+        out_file = os.path.join(tmp_dir, 'roi_data' + OUTPUT_EXTENSIONS[output_format])
+        times = []
+        try:
+            for _ in range(max(repeat, 1)):
+                start = time.perf_counter()
+                write_roi_data(out_file, roi_data, output_format=output_format)
+                times.append(time.perf_counter() - start)
+        except RuntimeError as e:  # optional dependency missing
+            results[output_format] = dict(skipped=str(e))
+            continue
+        results[output_format] = dict(min_s=min(times), median_s=statistics.median(times),
+                                      bytes=os.path.getsize(out_file))
+        os.remove(out_file)
+    return results
+
+
+def environment() -> dict:
+    import nilearn
+    import numpy
+    import scipy
+    from ..__about__ import __version__
+    return dict(atlasTransform=__version__, python=platform.python_version(), numpy=numpy.__version__,
+                scipy=scipy.__version__, nibabel=nibabel.__version__, nilearn=nilearn.__version__,
+                platform=platform.platform(), processor=platform.processor(), cpu_count=cpu_count(),
+                date=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+def run(opts) -> dict:
+    engines = opts.engines or EXTRACTION_ENGINES
+    formats = opts.formats or OUTPUT_FORMATS
+    cases = atlas_cases(opts.craddock_sizes)
+    if opts.cases:
+        cases = {name: inputs for name, inputs in cases.items() if name in opts.cases}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(opts.work_dir or tmp)
+        bids_dir = root / 'synthetic'
+        subject_data = make_synthetic_dataset(bids_dir, 1, 1, grid=opts.grid, n_volumes=opts.volumes,
+                                              seed=opts.seed)['001']
+        sources = {'4d': subject_data['bold'][0], '3d': subject_data['hurst'][0]}
+        atlas_cache_dir = str(root / 'atlas_cache')
+
+        results, writes = [], []
+        for kind, source in sources.items():
+            for name, case_inputs in cases.items():
+                # all granularities always use the native engine
+                for engine in engines if name != 'craddock_all' else ['native']:
+                    result = dict(input=kind, case=name, engine=engine)
+                    try:
+                        result.update(time_case(source, case_inputs, engine, opts.repeat, atlas_cache_dir,
+                                                str(bids_dir)))
+                    except Exception as e:  # e.g. power band-pass filtering needs a series
+                        result['failed'] = '%s: %s' % (type(e).__name__, e)
+                    results.append(result)
+                    print('%-3s %-14s %-8s %s' % (kind, name, engine, 'failed (%s)' % result['failed']
+                                                  if 'failed' in result else
+                                                  'cold %(cold_s)7.3fs  warm %(warm_min_s)7.3fs' % result))
+
+                if not formats or 'failed' in results[-1]:
+                    continue
+                interface = _interface(case_inputs, engines[0], atlas_cache_dir, str(bids_dir))
+                roi_data = _roi_data(interface, source)
+                for output_format, timing in time_formats(roi_data, formats, opts.repeat, str(root)).items():
+                    writes.append(dict(input=kind, case=name, format=output_format, **timing))
+
+    return dict(environment=environment(),
+                parameters=dict(grid=opts.grid, shape=list(GRIDS[opts.grid][0]), volumes=opts.volumes,
+                                repeat=opts.repeat, seed=opts.seed),
+                extraction=results, writes=writes)
+
+
+def _roi_data(interface, source):
+    """the first roi data array interface extracts from source"""
+    from ..interfaces.atlasTransform import _extract
+    source_img = nibabel.load(source)
+    atlas_names = interface.inputs.atlas_name if isinstance(interface.inputs.atlas_name, list) else [
+        interface.inputs.atlas_name]
+    extractor = interface._extractor(atlas_names[0], source_img, False, 0)
+    return _extract([extractor], source_img)[0][0][0]
+
+
+def compare(baseline: dict, current: dict) -> list:
+    """
+    :return: (input, case, engine or format, baseline time, current time, ratio) of every entry both
+        results have, warm median times for extractions and median times for writes
+    """
+    rows = []
+    for section, key, metric in [('extraction', 'engine', 'warm_median_s'), ('writes', 'format', 'median_s')]:
+        before = {(entry['input'], entry['case'], entry[key]): entry.get(metric) for entry in baseline[section]}
+        for entry in current[section]:
+            label = (entry['input'], entry['case'], entry[key])
+            if before.get(label) and entry.get(metric):
+                rows.append(label + (before[label], entry[metric], entry[metric] / before[label]))
+    return rows
+
+
+def get_parser():
+    parser = ArgumentParser(description='time every atlas, extraction engine and output format on synthetic data')
+    parser.add_argument('--output', default=None, help='write the results to this json file')
+    parser.add_argument('--compare', default=None, help='results of an earlier run to compare against')
+    parser.add_argument('--grid', choices=list(GRIDS), default='2mm')
+    parser.add_argument('--volumes', type=int, default=200, help='volumes of the 4D series')
+    parser.add_argument('--repeat', type=int, default=3, help='warm runs per case')
+    parser.add_argument('--cases', nargs='+', default=None, help='only run these cases (e.g. shen_2mm power)')
+    parser.add_argument('--craddock-sizes', type=int, nargs='+', default=DEFAULT_CRADDOCK_SIZES,
+                        help='craddock cluster sizes to time one by one')
+    parser.add_argument('--engines', nargs='+', default=None, help='extraction engines (all by default)')
+    parser.add_argument('--formats', nargs='*', default=None, help='output formats (all by default)')
+    parser.add_argument('--work-dir', default=None,
+                        help='keep the synthetic data and atlas cache here (a temporary folder if not given)')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+def main(argv=None):
+    opts = get_parser().parse_args(argv)
+    results = run(opts)
+    if opts.output is not None:
+        with open(opts.output, 'w') as fobj:
+            json.dump(results, fobj, indent=2)
+    if opts.compare is not None:
+        with open(opts.compare) as fobj:
+            baseline = json.load(fobj)
+        print('\n%-3s %-14s %-8s %10s %10s %7s' % ('', 'case', '', 'baseline', 'current', 'ratio'))
+        for kind, case, variant, before, after, ratio in compare(baseline, results):
+            print('%-3s %-14s %-8s %9.3fs %9.3fs %7.2f' % (kind, case, variant, before, after, ratio))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Command line startup benchmark
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+
+Times ``atlasTransform --help``, ``--version`` and an invalid invocation (argument validation
+only) in fresh interpreters, and checks that none of them imports a heavy dependency. Exits
+with 1 if a median time is over its target or a heavy module was imported, so it can gate CI:
+
+    python -m atlasTransform.benchmarks.startup --repeat 10
+"""
+import json
+import statistics
+import subprocess
+import sys
+import time
+from argparse import SUPPRESS, ArgumentParser
+
+# seconds, median of fresh processes; the bare interpreter takes ~0.05s of it
+TARGETS = {
+    'help': 0.5,
+    'version': 0.5,
+    'invalid': 0.5,
+}
+INVOCATIONS = {
+    'help': ['--help'],
+    'version': ['--version'],
+    'invalid': ['bids_dir', 'output_dir', 'participant', 'not_an_atlas'],
+}
+HEAVY_MODULES = ['numpy', 'scipy', 'nibabel', 'nilearn', 'nipype', 'niworkflows', 'bids', 'templateflow',
+                 'requests', 'pandas']
+
+
+def time_invocation(args: list, repeat: int) -> list:
+    """wall times of running the atlasTransform entry point with args in fresh interpreters"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-m', 'atlasTransform.benchmarks.startup', '--single', '--'] + args,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def heavy_imports(args: list) -> list:
+    """the HEAVY_MODULES imported by the time the entry point exits with args"""
+    result = subprocess.run([sys.executable, '-m', 'atlasTransform.benchmarks.startup', '--single', '--modules',
+                             '--'] + args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            universal_newlines=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def _single(args: list, report_modules: bool):
+    from ..cli.run import main as run_main
+    sys.argv = ['atlasTransform'] + args
+    try:
+        run_main()
+    except SystemExit:
+        pass
+    finally:
+        if report_modules:
+            sys.stdout.write('\n' + json.dumps([name for name in HEAVY_MODULES if name in sys.modules]) + '\n')
+
+
+def get_parser():
+    parser = ArgumentParser(description='time the startup of the atlasTransform command line')
+    parser.add_argument('--repeat', type=int, default=5, help='fresh processes per invocation')
+    parser.add_argument('--output', default=None, help='write the results to this json file')
+    parser.add_argument('--single', action='store_true', help=SUPPRESS)
+    parser.add_argument('--modules', action='store_true', help=SUPPRESS)
+    return parser
+
+
+def main(argv=None):
+    opts, args = get_parser().parse_known_args(argv)
+    if args and args[0] == '--':
+        args = args[1:]
+    if opts.single:
+        _single(args, opts.modules)
+        return
+
+    results = {}
+    print('%-8s %9s %9s %9s  %s' % ('', 'median', 'min', 'target', 'heavy imports'))
+    for name, invocation in INVOCATIONS.items():
+        times = time_invocation(invocation, opts.repeat)
+        modules = heavy_imports(invocation)
+        results[name] = dict(args=invocation, median_s=statistics.median(times), min_s=min(times),
+                             target_s=TARGETS[name], heavy_imports=modules,
+                             ok=statistics.median(times) <= TARGETS[name] and not modules)
+        print('%-8s %8.3fs %8.3fs %8.3fs  %s' % (name, results[name]['median_s'], results[name]['min_s'],
+                                                  TARGETS[name], ', '.join(modules) or '-'))
+
+    if opts.output is not None:
+        with open(opts.output, 'w') as fobj:
+            json.dump(results, fobj, indent=2)
+    sys.exit(int(not all(result['ok'] for result in results.values())))
+
+
+if __name__ == '__main__':
+    main()
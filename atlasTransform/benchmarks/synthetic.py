@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Synthetic BIDS derivatives
+^^^^^^^^^^^^^^^^^^^^^^^^^^
+
+Writes a small BIDS derivatives dataset of seeded random images on MNI-like grids that
+atlasTransform (and the benchmarks) can run on directly, without any download:
+
+- 4D ``..._desc-preproc_bold.nii.gz`` series of n_volumes volumes (``--source bold``)
+- 3D ``..._hurst.nii.gz`` maps, optionally with an uncertainty map next to them (``--source hurst``)
+
+    python -m atlasTransform.benchmarks.synthetic /tmp/synthetic --subjects 4 --runs 2 --grid 2mm --volumes 200
+"""
+import json
+from argparse import ArgumentParser
+from pathlib import Path
+
+import nibabel
+import numpy
+
+MNI_2MM_AFFINE = numpy.array([[-2., 0., 0., 90.], [0., 2., 0., -126.], [0., 0., 2., -72.], [0., 0., 0., 1.]])
+GRIDS = {
+    '1mm': ((182, 218, 182), numpy.array([[-1., 0., 0., 90.], [0., 1., 0., -126.], [0., 0., 1., -72.],
+                                          [0., 0., 0., 1.]])),
+    '2mm': ((91, 109, 91), MNI_2MM_AFFINE),
+    '3mm': ((61, 73, 61), numpy.array([[-3., 0., 0., 90.], [0., 3., 0., -126.], [0., 0., 3., -72.],
+                                       [0., 0., 0., 1.]])),
+}
+SPACE = 'MNI152NLin6Asym'
+REPETITION_TIME = 2.0
+
+
+def _series(rng, shape, n_volumes: int, dtype: str) -> numpy.ndarray:
+    """a baseline per voxel with noise around it, the way preprocessed bold series look"""
+    data = numpy.empty(shape + (n_volumes,), dtype=dtype)
+    baseline = rng.uniform(500, 1500, size=shape)
+    for volume in range(n_volumes):
+        data[..., volume] = baseline + rng.standard_normal(shape) * 20
+    return data
+
+
+def make_synthetic_dataset(root, n_subjects: int = 2, runs_per_subject: int = 1, grid: str = '2mm',
+                           n_volumes: int = 100, bold: bool = True, hurst: bool = True, uncertainty_suffix=None,
+                           dtype: str = 'int16', seed: int = 0) -> dict:
+    """
+    :param root: dataset folder (created)
+    :param grid: one of GRIDS
+    :param n_volumes: volumes of the bold series
+    :param bold: write 4D bold series
+    :param hurst: write 3D hurst maps
+    :param uncertainty_suffix: also write an uncertainty map with this suffix next to every hurst map
+    :param dtype: data type of the bold series (int16 or float32)
+    :param seed: seed of the random data, the same arguments always give the same dataset
+    :return: subject label -> {'bold': [files], 'hurst': [files]}, like utils.bids.collect_inventory
+    """
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    with (root / 'dataset_description.json').open('w') as fobj:
+        json.dump({'Name': 'atlasTransform synthetic dataset', 'BIDSVersion': '1.4.0', 'DatasetType': 'derivative',
+                   'GeneratedBy': [{'Name': 'atlasTransform.benchmarks.synthetic'}]}, fobj, indent=2)
+
+    shape, affine = GRIDS[grid]
+    rng = numpy.random.default_rng(seed)
+    subject_data = {}
+    for subject in range(1, n_subjects + 1):
+        label = '%03d' % subject
+        func = root / ('sub-' + label) / 'func'
+        func.mkdir(parents=True, exist_ok=True)
+        subject_data[label] = {'bold': [], 'hurst': []}
+        for run in range(1, runs_per_subject + 1):
+            prefix = 'sub-%s_task-rest_run-%d_space-%s' % (label, run, SPACE)
+            if bold:
+                img = nibabel.Nifti1Image(_series(rng, shape, n_volumes, dtype), affine)
+                img.header.set_xyzt_units('mm', 'sec')
+                img.header['pixdim'][4] = REPETITION_TIME
+                bold_file = func / (prefix + '_desc-preproc_bold.nii.gz')
+                img.to_filename(str(bold_file))
+                subject_data[label]['bold'].append(str(bold_file))
+            if hurst:
+                hurst_file = func / (prefix + '_hurst.nii.gz')
+                nibabel.Nifti1Image(rng.uniform(0.5, 1., size=shape).astype(numpy.float32), affine).to_filename(
+                    str(hurst_file))
+                subject_data[label]['hurst'].append(str(hurst_file))
+                if uncertainty_suffix is not None:
+                    nibabel.Nifti1Image(rng.uniform(0.01, 0.1, size=shape).astype(numpy.float32), affine).to_filename(
+                        str(func / (prefix + '_%s.nii.gz' % uncertainty_suffix)))
+    return subject_data
+
+
+def get_parser():
+    parser = ArgumentParser(description='write a synthetic BIDS derivatives dataset atlasTransform can run on')
+    parser.add_argument('root', help='dataset folder')
+    parser.add_argument('--subjects', type=int, default=2)
+    parser.add_argument('--runs', type=int, default=1, help='runs per subject')
+    parser.add_argument('--grid', choices=list(GRIDS), default='2mm')
+    parser.add_argument('--volumes', type=int, default=100, help='volumes of the bold series')
+    parser.add_argument('--no-bold', action='store_true', help='only write hurst maps')
+    parser.add_argument('--no-hurst', action='store_true', help='only write bold series')
+    parser.add_argument('--uncertainty-suffix', default=None,
+                        help='also write an uncertainty map with this BIDS suffix next to every hurst map')
+    parser.add_argument('--dtype', choices=['int16', 'float32'], default='int16')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+def main(argv=None):
+    opts = get_parser().parse_args(argv)
+    subject_data = make_synthetic_dataset(opts.root, opts.subjects, opts.runs, grid=opts.grid,
+                                          n_volumes=opts.volumes, bold=not opts.no_bold, hurst=not opts.no_hurst,
+                                          uncertainty_suffix=opts.uncertainty_suffix, dtype=opts.dtype,
+                                          seed=opts.seed)
+    print('%d subjects, %d files in %s' % (len(subject_data), sum(
+        len(files) for data in subject_data.values() for files in data.values()), opts.root))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,6 @@
-import re
 from multiprocessing import cpu_count
 from pathlib import Path
 
-from bids import BIDSLayout
-
 
 def build_workflow(opts, retval):
     from nipype import logging as nlogging, config as ncfg
@@ -13,6 +10,7 @@ def build_workflow(opts, retval):
     from time import strftime
     import uuid
     from ..workflows.base import init_base_wf
+    from ..utils.bids import load_layout, collect_inventory, LAYOUT_DB_DIR
 
     build_log = nlogging.getLogger('nipype.workflow')
 
@@ -48,9 +46,7 @@ def build_workflow(opts, retval):
     retval['run_uuid'] = run_uuid
 
     # First check that bids_dir looks like a BIDS folder
-    layout = BIDSLayout(str(bids_dir), validate=False,
-                        ignore=("code", "stimuli", "sourcedata", "models",
-                                "derivatives", re.compile(r'^\.')))
+    layout = load_layout(bids_dir, work_dir / LAYOUT_DB_DIR, reindex=opts.reindex_bids)
     subject_list = collect_participants(
         layout, participant_label=opts.participant_label)
     retval['subject_list'] = subject_list
@@ -150,6 +146,8 @@ def build_workflow(opts, retval):
         subject_list=subject_list,
         work_dir=str(work_dir),
         output_dir=str(output_dir),
+        subject_data=collect_inventory(layout, subject_list, task=opts.task_id, session=opts.session_id,
+                                       run=opts.run_id, space=opts.space),
     )
     retval['return_code'] = 0
 
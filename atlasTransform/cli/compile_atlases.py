@@ -0,0 +1,30 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+compile the bundled atlases into memory-mappable bundles
+=====
+"""
+from argparse import ArgumentParser
+
+
+def get_parser():
+    from ..utils.bundle import BUNDLE_DIR_ENV, default_bundle_dir
+    parser = ArgumentParser(description='compile the shen and craddock atlases into uncompressed, memory-mappable '
+                                        'bundles that are used instead of the nifti files when present')
+    parser.add_argument('--out-dir', '--out_dir', action='store', default=None,
+                        help='where to write the bundles (default: $%s or %s); atlasTransform looks for them in '
+                             'the same place' % (BUNDLE_DIR_ENV, default_bundle_dir()))
+    return parser
+
+
+def main(argv=None):
+    """Entry point"""
+    from ..utils.atlas import compile_atlases
+    opts = get_parser().parse_args(argv)
+    for path in compile_atlases(bundle_dir=opts.out_dir):
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
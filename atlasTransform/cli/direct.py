@@ -0,0 +1,94 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+direct execution engine
+=====
+Runs the atlas transforms of every (subject, run) on a process pool without building a nipype
+workflow: no node working directories, result pickling or graph scheduling. Each worker keeps one
+interface, so its atlases and voxel indices are reused by all the runs it gets.
+"""
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count
+
+_INTERFACE = None
+
+
+def _init_worker(inputs):
+    global _INTERFACE
+    from ..interfaces import AtlasTransform
+    _INTERFACE = AtlasTransform(**inputs)
+
+
+def _transform(source, uncertainty, atlas_names, manifest_keys):
+    _INTERFACE.inputs.atlas_name = atlas_names
+    return _INTERFACE._transform(source, uncertainty, manifest_keys)
+
+
+def collect_work_items(opts, layout, subject_list, output_dir) -> list:
+    """:return: (source file, uncertainty map or None, atlas names, manifest keys or None) of every run to process"""
+    from ..utils.bids import collect_inventory
+    from ..workflows.base import iter_runs
+    from ..workflows.atlasTransformWorkflow import prepare_shared_atlases
+    inventory = collect_inventory(layout, subject_list, task=opts.task_id, session=opts.session_id, run=opts.run_id,
+                                  space=opts.space)
+    items = []
+    for subject_id in subject_list:
+        for _, source, uncertainty, atlas_names, manifest_keys in iter_runs(opts, inventory[subject_id][opts.source],
+                                                                            str(output_dir)):
+            prepare_shared_atlases(source, atlas_names, opts)
+            items.append((source, uncertainty, atlas_names, manifest_keys))
+    return items
+
+
+def run_direct(opts, logger) -> int:
+    """
+    :return: exit code (1 if any run failed)
+    """
+    from niworkflows.utils.bids import collect_participants
+    from ..utils.bids import load_layout, LAYOUT_DB_DIR
+    from ..utils.group_store import group_store_dir, merge_group_store
+    from ..utils.profiling import profile_dir, summarize_profiles
+    from ..workflows.atlasTransformWorkflow import interface_inputs
+
+    output_dir = opts.output_dir.resolve()
+    layout = load_layout(opts.bids_dir.resolve(), opts.work_dir.resolve() / LAYOUT_DB_DIR,
+                         reindex=opts.reindex_bids)
+    subject_list = collect_participants(layout, participant_label=opts.participant_label)
+    items = collect_work_items(opts, layout, subject_list, output_dir)
+
+    inputs = interface_inputs(opts)
+    inputs['bids_dir'] = str(layout.root)
+    nthreads = opts.nthreads if opts.nthreads is not None and opts.nthreads > 0 else cpu_count()
+    logger.log(25, 'Running %d runs of %d subjects on %d processes', len(items), len(subject_list), nthreads)
+
+    failed = 0
+    start = time.time()
+    try:
+        with ProcessPoolExecutor(max_workers=nthreads, initializer=_init_worker, initargs=(inputs,)) as pool:
+            futures = {pool.submit(_transform, *item): item[0] for item in items}
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    future.result()
+                except Exception as e:
+                    failed += 1
+                    logger.error('[%d/%d] %s failed: %s', done, len(items), futures[future], e)
+                    if opts.stop_on_first_crash:
+                        for pending in futures:
+                            pending.cancel()
+                        break
+                else:
+                    logger.log(25, '[%d/%d] %s done (%.1fs elapsed)', done, len(items), futures[future],
+                               time.time() - start)
+    finally:
+        if opts.group_store is not None:
+            merge_group_store(group_store_dir(output_dir))
+        if opts.profile == 'summary':
+            summarize_profiles(profile_dir(output_dir))
+
+    if failed:
+        logger.critical('atlasTransform failed for %d of %d runs', failed, len(items))
+        return 1
+    logger.log(25, 'atlasTransform finished without errors')
+    return 0
@@ -0,0 +1,122 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+memory report
+=====
+Compares the peak memory estimated from the headers (the mem_gb of the workflow nodes, see
+utils.memory) with the peak RSS measured when transforming a sample of the runs, each in a fresh
+process. Takes the usual atlasTransform arguments, e.g.
+
+    atlasTransform-memory-report --max-runs 5 -- bids_dir output_dir participant shen --source hurst
+"""
+import json
+import resource
+import subprocess
+import sys
+from argparse import ArgumentParser, SUPPRESS
+
+
+def get_parser():
+    parser = ArgumentParser(description='compare the estimated peak memory of the runs of a dataset with their '
+                                        'measured peak RSS; the remaining arguments are those of atlasTransform')
+    parser.add_argument('--max-runs', '--max_runs', action='store', type=int, default=10,
+                        help='number of runs measured, evenly spread from the smallest to the largest input')
+    parser.add_argument('--output', action='store', default=None, help='also write the report to this json file')
+    parser.add_argument('--single', action='store', nargs=2, default=None, help=SUPPRESS)
+    return parser
+
+
+def measure_peak_gb(run_opts, source, uncertainty=None) -> float:
+    """Transform source in this process and return the peak RSS of the process in GB"""
+    from ..interfaces import AtlasTransform
+    from ..workflows.atlasTransformWorkflow import interface_inputs
+    inputs = interface_inputs(run_opts)
+    for field in ['group_store', 'manifest_dir']:
+        inputs.pop(field, None)
+    inputs['write_files'] = False
+    interface = AtlasTransform(atlas_name=run_opts.atlas_name, **inputs)
+    interface._transform(source, uncertainty)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2
+
+
+def sample_runs(runs: list, max_runs: int) -> list:
+    """max_runs of runs, evenly spread over the runs sorted by decoded size"""
+    from ..utils.memory import header_info
+    sizes = []
+    for source, uncertainty in runs:
+        info = header_info(source)
+        voxels = 1
+        for size in info['shape']:
+            voxels *= size
+        sizes.append(voxels * info['itemsize'])
+    runs = [run for _, run in sorted(zip(sizes, runs), key=lambda pair: pair[0])]
+    if len(runs) <= max_runs:
+        return runs
+    step = (len(runs) - 1) / max(max_runs - 1, 1)
+    return [runs[round(i * step)] for i in range(max_runs)]
+
+
+def main(argv=None):
+    """Entry point"""
+    from .run_utils import get_parser as get_run_parser
+    opts, run_args = get_parser().parse_known_args(argv)
+    if run_args and run_args[0] == '--':
+        run_args = run_args[1:]
+    run_opts = get_run_parser().parse_args(run_args)
+
+    if opts.single is not None:
+        source, uncertainty = opts.single
+        print(json.dumps(dict(peak_rss_gb=measure_peak_gb(run_opts, source, uncertainty or None))))
+        return
+
+    from niworkflows.utils.bids import collect_participants
+    from ..interfaces.atlasTransform import LOW_MEM_BLOCK_SIZE
+    from ..utils.bids import LAYOUT_DB_DIR, collect_inventory, get_uncertainty_map, load_layout
+    from ..utils.memory import header_info, memory_model
+    from ..workflows.atlasTransformWorkflow import prepare_shared_atlases, run_mem_gb
+
+    layout = load_layout(run_opts.bids_dir.resolve(), run_opts.work_dir.resolve() / LAYOUT_DB_DIR,
+                         reindex=run_opts.reindex_bids)
+    subject_list = collect_participants(layout, participant_label=run_opts.participant_label)
+    inventory = collect_inventory(layout, subject_list, task=run_opts.task_id, session=run_opts.session_id,
+                                  run=run_opts.run_id, space=run_opts.space)
+    runs = []
+    for subject_id in subject_list:
+        for source in inventory[subject_id][run_opts.source]:
+            uncertainty = None
+            if run_opts.uncertainty_suffix is not None:
+                uncertainty = get_uncertainty_map(source, run_opts.uncertainty_suffix)
+            runs.append((source, uncertainty))
+
+    report = []
+    print('%-60s %-18s %-9s %10s %10s %7s' % ('source', 'shape', 'model', 'estimate', 'peak rss', 'ratio'))
+    for source, uncertainty in sample_runs(runs, opts.max_runs):
+        # the atlases are prepared by the process building the workflow, not by the node
+        prepare_shared_atlases(source, run_opts.atlas_name, run_opts)
+        estimate_gb = run_mem_gb(source, run_opts.atlas_name, run_opts, uncertainty)
+        measured = subprocess.run(
+            [sys.executable, '-m', 'atlasTransform.cli.memory_report', '--single', source, uncertainty or '', '--'] +
+            run_args, stdout=subprocess.PIPE, universal_newlines=True)
+        peak_gb = None
+        if measured.returncode == 0:
+            peak_gb = json.loads(measured.stdout.strip().splitlines()[-1])['peak_rss_gb']
+        info = header_info(source)
+        block_size = run_opts.block_size or (LOW_MEM_BLOCK_SIZE if run_opts.low_mem else 0)
+        streamed = len(info['shape']) == 4 and 0 < block_size < info['shape'][3]
+        models = sorted({memory_model(atlas_name, run_opts.extraction_engine, streamed, uncertainty is not None,
+                                      run_opts.all_granularities) for atlas_name in run_opts.atlas_name})
+        report.append(dict(source=source, uncertainty=uncertainty, shape=info['shape'], itemsize=info['itemsize'],
+                           compressed=info['compressed'], models=models, estimate_gb=estimate_gb,
+                           peak_rss_gb=peak_gb))
+        print('%-60s %-18s %-9s %9.2fG %s' % (
+            source[-60:], 'x'.join(str(size) for size in info['shape']), ','.join(models)[:9], estimate_gb,
+            '%9.2fG %7.2f' % (peak_gb, estimate_gb / peak_gb) if peak_gb is not None else '   failed'))
+
+    if opts.output is not None:
+        with open(opts.output, 'w') as fobj:
+            json.dump(report, fobj, indent=2)
+
+
+if __name__ == '__main__':
+    main()
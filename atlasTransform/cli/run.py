@@ -35,6 +35,14 @@ def main():
         if not opts.notrack:
             pass#sentry_sdk.capture_message('atlasTransform finished without errors',
                    #                    level='info')
+    finally:
+        if opts.group_store is not None:
+            # shards of the runs that finished are kept even if others failed
+            from ..utils.group_store import group_store_dir, merge_group_store
+            merge_group_store(group_store_dir(output_dir))
+        if opts.profile == 'summary':
+            from ..utils.profiling import profile_dir, summarize_profiles
+            summarize_profiles(profile_dir(output_dir))
     # finally:
     #     from niworkflows.reports import generate_reports
     #     from subprocess import check_call, CalledProcessError, TimeoutExpired
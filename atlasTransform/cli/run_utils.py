@@ -6,7 +6,11 @@ import gc
 import warnings
 from argparse import ArgumentParser
 from argparse import ArgumentDefaultsHelpFormatter
-from ..utils.atlas import CRADDOCK_CLUSTER_SIZES
+# only the standard library and utils.constants are imported before the arguments are parsed,
+# so --help, --version and invalid arguments return at once
+from ..utils.constants import (CRADDOCK_CLUSTER_SIZES, DEFAULT_BOLD_CACHE_GB, EXTRACTION_ENGINES,
+                               GROUP_STORE_MODES, OUTPUT_FORMATS, OUTPUT_PRECISIONS, PROFILE_MODES,
+                               SPHERE_OVERLAP_POLICIES)
 
 
 def _warn_redirect(message, category, filename, lineno, logger, file=None, line=None):
@@ -24,13 +28,9 @@ def check_deps(workflow):
 
 def get_parser():
     """Build parser object"""
-    from packaging.version import Version
     from ..__about__ import __version__
-    from .version import check_latest, is_flagged
 
     verstr = 'atlasTransform v{}'.format(__version__)
-    currentv = Version(__version__)
-    is_release = not any((currentv.is_devrelease, currentv.is_prerelease, currentv.is_postrelease))
 
     parser = ArgumentParser(description='atlasTransform: transforming 3D and 4D nifti files into atlas space',
                             formatter_class=ArgumentDefaultsHelpFormatter)
@@ -47,8 +47,9 @@ def get_parser():
     parser.add_argument('analysis_level', choices=['participant'],
                         help='processing stage to be run, only "participant" in the case of '
                              'atlasTransform (see BIDS-Apps specification).')
-    parser.add_argument('atlas_name', choices=['craddock', 'shen', 'power'],
-                        help='Which file format is the time series data coming from?')
+    parser.add_argument('atlas_name', choices=['craddock', 'shen', 'power'], nargs='+',
+                        help='Which atlas(es) to extract. Several atlases are extracted from a single '
+                             'load of each input image.')
     # optional arguments
     parser.add_argument('--resolution', choices=[1, 2],
                         help='shen atlas resolution',
@@ -59,6 +60,22 @@ def get_parser():
     parser.add_argument('--number_of_clusters', choices=CRADDOCK_CLUSTER_SIZES,
                         help='craddock atlas granularity',
                         action='store', type=int, default=200)
+    parser.add_argument('--all-granularities', '--all_granularities', action='store_true', default=False,
+                        help='extract every craddock cluster size in a single pass (ignores '
+                             '--number_of_clusters)')
+    parser.add_argument('--uncertainty-suffix', '--uncertainty_suffix', action='store', default=None,
+                        help='BIDS suffix of the per-voxel uncertainty maps stored next to each input '
+                             '(e.g. standard errors of the hurst maps); the propagated roi uncertainty '
+                             'is written as a confidence interval file')
+    parser.add_argument('--output-format', '--output_format', action='store', choices=OUTPUT_FORMATS,
+                        help='file format of the roi data (hdf5 needs h5py, parquet needs pyarrow)',
+                        default='csv')
+    parser.add_argument('--output-precision', '--output_precision', action='store', choices=OUTPUT_PRECISIONS,
+                        help='floating point precision of the roi data', default='float64')
+    parser.add_argument('--group-store', '--group_store', action='store', choices=GROUP_STORE_MODES, default=None,
+                        help='also collect the roi data of all runs in one HDF5 store with a subject/session/'
+                             'task/run/atlas index under <output_dir>/atlasTransform/group_store (alongside), '
+                             'or only there instead of one file per run (only); needs h5py')
     parser.add_argument('--version', action='version', version=verstr)
 
     parser.add_argument('--algorithm', action='store', choices=['2level', 'mean', None],
@@ -67,15 +84,33 @@ def get_parser():
     parser.add_argument('--similarity_measure', action='store', choices=['t','s'],
                         help='which craddock similarity measure to use', default='t')
 
+    parser.add_argument('--extraction-engine', '--extraction_engine', action='store', choices=EXTRACTION_ENGINES,
+                        help='how roi means are computed: nilearn\'s maskers or the precomputed label and '
+                             'sphere indices', default='nilearn')
+    parser.add_argument('--sphere-radius', '--sphere_radius', action='store', type=float, default=None,
+                        help='power sphere radius in mm (the single nearest voxel if not given)')
+    parser.add_argument('--sphere-overlap', '--sphere_overlap', action='store', choices=SPHERE_OVERLAP_POLICIES,
+                        help='what to do with voxels shared by power spheres: fail, count them in every '
+                             'sphere, or only in the sphere with the nearest seed', default='error')
+
     g_bids = parser.add_argument_group('Options for filtering BIDS queries')
     g_bids.add_argument('--skip_bids_validation', '--skip-bids-validation', action='store_true',
                         default=False,
                         help='assume the input dataset is BIDS compliant and skip the validation')
+    g_bids.add_argument('--reindex-bids', '--reindex_bids', action='store_true', default=False,
+                        help='index the whole input dataset again instead of refreshing the index kept in '
+                             '<work-dir>/bids_db from the directories that changed since the last run')
     g_bids.add_argument('--participant_label', '--participant-label', action='store', nargs='+',
                         help='a space delimited list of participant identifiers or a single '
                              'identifier (the sub- prefix can be removed)')
     g_bids.add_argument('-t', '--task-id', action='store',
                         help='select a specific task to be processed')
+    g_bids.add_argument('--session-id', '--session_id', action='store',
+                        help='select a specific session to be processed')
+    g_bids.add_argument('--run-id', '--run_id', action='store', type=int,
+                        help='select a specific run to be processed')
+    g_bids.add_argument('--space', action='store',
+                        help='select the inputs resampled to a specific space (e.g. MNI152NLin2009cAsym)')
 
     g_perfm = parser.add_argument_group('Options to handle performance')
     g_perfm.add_argument('--nthreads', '--n_cpus', '-n-cpus', action='store', type=int,
@@ -85,8 +120,33 @@ def get_parser():
     g_perfm.add_argument('--mem_mb', '--mem-mb', action='store', default=0, type=int,
                          help='upper bound memory limit for FMRIPREP processes')
     g_perfm.add_argument('--low-mem', action='store_true',
-                         help='attempt to reduce memory usage (will increase disk usage '
-                              'in working directory)')
+                         help='attempt to reduce memory usage by streaming 4D inputs in blocks of '
+                              'volumes (see --block-size)')
+    g_perfm.add_argument('--block-size', '--block_size', action='store', type=int, default=0,
+                         help='number of volumes of a 4D input read and reduced at a time; 0 reads the '
+                              'whole series (or blocks of 100 volumes with --low-mem)')
+    g_perfm.add_argument('--bold-cache', action='store_true', default=False,
+                         help='inflate each .nii.gz input once into an uncompressed copy under '
+                              '<work-dir>/bold_cache and memory-map it in later runs')
+    g_perfm.add_argument('--bold-cache-gb', action='store', type=float, default=DEFAULT_BOLD_CACHE_GB,
+                         help='size cap of the uncompressed image cache, least recently used copies '
+                              'are removed')
+    g_perfm.add_argument('--engine', action='store', choices=['nipype', 'direct'], default='nipype',
+                         help='nipype builds and runs the full workflow (provenance, crash files, reports); '
+                              'direct runs the transforms on a process pool without building a workflow')
+    g_perfm.add_argument('--batch-runs', '--batch_runs', action='store', type=int, default=0,
+                         help='process up to this many runs of a subject in one node, reusing the loaded '
+                              'atlases between them (0: one node per run)')
+    g_perfm.add_argument('--profile', action='store', choices=PROFILE_MODES, default=None,
+                         help='write the wall time, cpu time, bytes read and peak memory growth of every stage '
+                              'of every run to a json sidecar next to its outputs (sidecar), and also aggregate '
+                              'them into <output_dir>/atlasTransform/logs/profile_summary.json (summary)')
+    g_perfm.add_argument('--incremental', action='store_true', default=False,
+                         help='skip extractions whose input fingerprint, options and version match the '
+                              'manifest of a previous run (<output_dir>/atlasTransform/manifest)')
+    g_perfm.add_argument('--fingerprint-samples', '--fingerprint_samples', action='store', type=int, default=0,
+                         help='with --incremental, also hash this many sampled blocks of each input '
+                              '(catches rewrites that keep size and mtime)')
     g_perfm.add_argument('--use-plugin', action='store', default=None,
                          help='nipype plugin configuration file')
     g_perfm.add_argument('--boilerplate', action='store_true',
@@ -119,36 +179,27 @@ def get_parser():
                               'the atlasTransform developers. This information helps to '
                               'improve atlasTransform and provides an indicator of real '
                               'world usage crucial for obtaining funding.')
-
-    latest = check_latest()
-    if latest is not None and currentv < latest:
-        print("""\
-You are using atlasTransform-%s, and a newer version of atlasTransform is available: %s.
-Please check out our documentation about how and when to upgrade""" % (
-            __version__, latest), file=sys.stderr)
-
-    _blist = is_flagged()
-    if _blist[0]:
-        _reason = _blist[1] or 'unknown'
-        print("""\
-WARNING: Version %s of atlasTransform (current) has been FLAGGED
-(reason: %s).
-That means some severe flaw was found in it and we strongly
-discourage its usage.""" % (__version__, _reason), file=sys.stderr)
+    g_other.add_argument('--no-version-check', '--no_version_check', action='store_true', default=False,
+                         help='do not look for a newer release (the check runs in the background '
+                              'while the workflow is built; skip it for large arrays of short jobs)')
 
     return parser
 
 
 def get_workflow(logger):
-    from nipype import logging as nlogging
-    from multiprocessing import set_start_method, Process, Manager
-    from ..utils.bids import validate_input_dir
-    from .build_workflow import build_workflow
+    from multiprocessing import set_start_method
     if __name__ == 'main':
         set_start_method('forkserver')
     warnings.showwarning = _warn_redirect
     opts = get_parser().parse_args()
 
+    if not opts.no_version_check:
+        from .version import start_version_check
+        start_version_check()
+    from nipype import logging as nlogging
+    from ..utils.bids import validate_input_dir
+    from .build_workflow import build_workflow
+
     exec_env = os.name
 
     # special variable set in the container
@@ -173,26 +224,37 @@ def get_workflow(logger):
     log_level = int(max(25 - 5 * opts.verbose_count, logging.DEBUG))
     # Set logging
     logger.setLevel(log_level)
+    if not logger.handlers:
+        # the cli logger reports progress at level 25, which logging's last resort handler drops
+        handler = logging.StreamHandler(stream=sys.stdout)
+        handler.setFormatter(logging.Formatter(fmt=nlogging.fmt, datefmt=nlogging.datefmt))
+        logger.addHandler(handler)
+        logger.propagate = False
     nlogging.getLogger('nipype.workflow').setLevel(log_level)
     nlogging.getLogger('nipype.interface').setLevel(log_level)
     nlogging.getLogger('nipype.utils').setLevel(log_level)
 
-    # Call build_workflow(opts, retval)
-    with Manager() as mgr:
-        retval = mgr.dict()
-        p = Process(target=build_workflow, args=(opts, retval))
-        p.start()
-        p.join()
-
-        retcode = p.exitcode or retval.get('return_code', 0)
-
-        bids_dir = Path(retval.get('bids_dir'))
-        output_dir = Path(retval.get('output_dir'))
-        work_dir = Path(retval.get('work_dir'))
-        plugin_settings = retval.get('plugin_settings', None)
-        subject_list = retval.get('subject_list', None)
-        atlas_transform_wf = retval.get('workflow', None)
-        run_uuid = retval.get('run_uuid', None)
+    if opts.engine == 'direct':
+        from .direct import run_direct
+        sys.exit(run_direct(opts, logger))
+
+    # Build the workflow in this process: sending it back from a child process pickles every node,
+    # which costs more than building it for large cohorts
+    retval = {}
+    try:
+        build_workflow(opts, retval)
+    except Exception:
+        logger.critical('atlasTransform failed to build the workflow', exc_info=True)
+        retval['return_code'] = 1
+    retcode = retval.get('return_code', 0)
+
+    bids_dir = Path(retval.get('bids_dir'))
+    output_dir = Path(retval.get('output_dir'))
+    work_dir = Path(retval.get('work_dir'))
+    plugin_settings = retval.get('plugin_settings', None)
+    subject_list = retval.get('subject_list', None)
+    atlas_transform_wf = retval.get('workflow', None)
+    run_uuid = retval.get('run_uuid', None)
 
     if opts.reports_only:
         sys.exit(int(retcode > 0))
@@ -2,9 +2,10 @@
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 """Version CLI helpers."""
 
+import sys
+import threading
 from pathlib import Path
 from datetime import datetime
-import requests
 from .. import __version__
 
 RELEASE_EXPIRY_DAYS = 14
@@ -41,6 +42,7 @@ def check_latest():
 
     if latest is None or outdated is True:
         try:
+            import requests
             response = requests.get(url='https://pypi.org/pypi/atlasTransform/json', timeout=1.0)
         except Exception:
             response = None
@@ -67,6 +69,7 @@ def is_flagged():
     # https://raw.githubusercontent.com/https://github.com/enlberman/atlasTransform/master/.versions.json
     flagged = tuple()
     try:
+        import requests
         response = requests.get(url="""\
 https://raw.githubusercontent.com/https://github.com/enlberman/atlasTransform/master/.versions.json""", timeout=1.0)
     except Exception:
@@ -79,3 +82,35 @@ https://raw.githubusercontent.com/https://github.com/enlberman/atlasTransform/ma
         return True, flagged[__version__]
 
     return False, None
+
+
+def warn_version():
+    """Print a warning if a newer release is out or this version has been flagged."""
+    from packaging.version import Version
+
+    currentv = Version(__version__)
+    latest = check_latest()
+    if latest is not None and currentv < latest:
+        print("""\
+You are using atlasTransform-%s, and a newer version of atlasTransform is available: %s.
+Please check out our documentation about how and when to upgrade""" % (
+            __version__, latest), file=sys.stderr)
+
+    _blist = is_flagged()
+    if _blist[0]:
+        _reason = _blist[1] or 'unknown'
+        print("""\
+WARNING: Version %s of atlasTransform (current) has been FLAGGED
+(reason: %s).
+That means some severe flaw was found in it and we strongly
+discourage its usage.""" % (__version__, _reason), file=sys.stderr)
+
+
+def start_version_check():
+    """
+    Run warn_version in a daemon thread, so the requests to PyPI and GitHub (up to a second
+    each when offline) overlap with building the workflow instead of delaying it.
+    """
+    thread = threading.Thread(target=warn_version, name='version-check', daemon=True)
+    thread.start()
+    return thread
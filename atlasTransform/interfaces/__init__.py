@@ -7,7 +7,7 @@ from niworkflows.interfaces import (
     bids)#, utils)
 
 
-from .atlasTransform import AtlasTransform
+from .atlasTransform import AtlasTransform, AtlasTransformBatch
 
 
 class DerivativesDataSink(bids.DerivativesDataSink):
@@ -18,5 +18,6 @@ __all__ = [
     'bids',
   #  'utils',
     'DerivativesDataSink',
-    'AtlasTransform'
+    'AtlasTransform',
+    'AtlasTransformBatch',
 ]
\ No newline at end of file
@@ -1,56 +1,212 @@
+from collections import namedtuple
+from itertools import repeat
 from pathlib import Path
 
 from nipype.interfaces.base import (
     traits, TraitedSpec, SimpleInterface,
-    File)
+    File, OutputMultiObject, isdefined)
 from nipype import logging
 import numpy
 import nibabel
 import nilearn
 import nilearn.input_data
+import nilearn.signal
 import os
+from scipy import sparse
 from nipype.utils.filemanip import fname_presuffix
-from ..utils.atlas import load_craddock_2011, load_shen_268, load_power
+from ..utils.atlas import atlas_identity, load_atlas, load_craddock_2011_all, load_label_index
+from ..utils.constants import (CRADDOCK_CLUSTER_SIZES, DEFAULT_BOLD_CACHE_GB, EXTRACTION_ENGINES, OUTPUT_EXTENSIONS,
+                               OUTPUT_FORMATS, OUTPUT_PRECISIONS, SPHERE_OVERLAP_POLICIES)
+from ..utils.output import write_roi_data
+from ..utils.group_store import GROUP_STORE_FILE, write_shard
+from ..utils.manifest import record
+from ..utils.profiling import NULL_PROFILER, StageProfiler, record_profile, write_profile
+from ..utils.cache import BoldCache, ResampledAtlasCache
+from ..utils.extraction import (
+    LabelIndex, PartitionIndex, SphereIndex, get_sphere_index, iter_volume_blocks, same_grid)
 
 LOGGER = logging.getLogger('nipype.interface')
 
+POWER_SMOOTHING_FWHM = 6
+POWER_CLEANING = dict(detrend=True, standardize=True, low_pass=0.08, high_pass=0.009)
+LOW_MEM_BLOCK_SIZE = 100  # volumes per block when streaming with low_mem and no block_size
+
 
 class AtlasTransformInputSpec(TraitedSpec):
     nifti = traits.Any(mandatory=True, desc='input nifti')
-    atlas_name = traits.String(mandatory=True, desc='atlas name')
+    atlas_name = traits.Either(traits.String, traits.List(traits.String), mandatory=True,
+                               desc='atlas name or list of atlas names extracted from the same image')
     bids_dir = traits.String(mandatory=True, desc='atlas name')
     resolution = traits.Int(mandatory=False, desc='resolution (for shen atlas)')
     number_of_clusters = traits.Int(mandatory=False, desc='for craddock')
     similarity_measure = traits.String(mandatory=False, desc='for craddock')
     algorithm = traits.String(mandatory=False, desc='for craddock')
+    all_granularities = traits.Bool(False, usedefault=True,
+                                    desc='for craddock: extract every cluster size in one pass over the '
+                                         'intersection partition (one output per granularity)')
+    engine = traits.Enum(*EXTRACTION_ENGINES, usedefault=True, desc='roi extraction engine')
+    sphere_radius = traits.Float(mandatory=False,
+                                 desc='for power: sphere radius in mm (single nearest voxel if undefined)')
+    sphere_overlap = traits.Enum(*SPHERE_OVERLAP_POLICIES, usedefault=True,
+                                 desc='for power: voxels shared by spheres raise an error, count in every '
+                                      'sphere (allow) or only in the sphere with the nearest seed')
+    block_size = traits.Int(mandatory=False,
+                            desc='stream 4D inputs in blocks of this many volumes (bounds peak memory)')
+    low_mem = traits.Bool(False, usedefault=True,
+                          desc='stream 4D inputs in blocks of %d volumes unless block_size is set' % LOW_MEM_BLOCK_SIZE)
+    cache_dir = traits.String(mandatory=False,
+                              desc='keep uncompressed copies of .nii.gz inputs here and memory-map them')
+    cache_size_gb = traits.Float(DEFAULT_BOLD_CACHE_GB, usedefault=True,
+                                 desc='size cap of cache_dir, least recently used copies are removed')
+    atlas_cache_dir = traits.String(mandatory=False,
+                                    desc='keep atlases resampled to the source grid here (in memory only if undefined)')
+    output_format = traits.Enum(*OUTPUT_FORMATS, usedefault=True, desc='file format of the roi data')
+    precision = traits.Enum(*OUTPUT_PRECISIONS, usedefault=True, desc='floating point precision of the roi data')
+    uncertainty = File(exists=True, mandatory=False,
+                       desc='per-voxel uncertainty of nifti (e.g. standard error map), propagated to the rois')
+    group_store = traits.String(mandatory=False,
+                                desc='also append the roi data to this group store (as a shard merged at the end)')
+    write_files = traits.Bool(True, usedefault=True,
+                              desc='write one roi data file per atlas next to the other derivatives')
+    manifest_dir = traits.String(mandatory=False, desc='record finished extractions here for incremental reruns')
+    manifest_keys = traits.Dict(traits.String, traits.String, mandatory=False,
+                                desc='extraction key of every atlas name, recorded in manifest_dir')
+    profile = traits.Bool(False, usedefault=True,
+                          desc='write the wall time, cpu time, bytes read and peak memory growth of every stage '
+                               'to a json sidecar next to the outputs')
+    profile_dir = traits.String(mandatory=False, desc='also leave a copy of the profile here for the run summary')
 
 
 class AtlasTransformOutputSpec(TraitedSpec):
     out_report = File(exists=True, desc='conformation report')
-    transformed = File(exists=True, desc='atlas file')
-    confidence_intervals = File(exists=False, desc='confidence interval file')
+    transformed = OutputMultiObject(File(exists=True), desc='atlas file (one per atlas name)')
+    confidence_intervals = OutputMultiObject(File(exists=True),
+                                             desc='propagated roi uncertainty (one per atlas name)')
+    group_shard = File(exists=True, desc='group store shard holding the roi data of all atlases')
+    profile = File(exists=True, desc='stage profile of the extraction')
+
+
+# extract(data, errors) reduces a block of volumes, finalize (if any) runs once on the concatenated results
+_Extractor = namedtuple('_Extractor', ['out_names', 'extract', 'finalize'], defaults=(None,))
+
+
+def _extract(extractors, source_img, error_img=None, block_size=0, profiler=NULL_PROFILER):
+    """
+    Run every extractor over the source image, in blocks of block_size volumes when streaming.
+    :return: for every extractor, one (roi data, propagated errors or None) pair per output name
+    """
+    if block_size:
+        blocks = iter_volume_blocks(source_img, block_size)
+        error_blocks = iter_volume_blocks(error_img, block_size) if error_img is not None else repeat(None)
+    else:
+        with profiler.stage('read'):
+            blocks = [numpy.asanyarray(source_img.dataobj)]
+            error_blocks = [numpy.asanyarray(error_img.dataobj) if error_img is not None else None]
+
+    partial = [[] for _ in extractors]
+    block_pairs = zip(blocks, error_blocks)
+    while True:
+        # streamed blocks are read (and inflated) when they are drawn
+        with profiler.stage('read'):
+            pair = next(block_pairs, None)
+        if pair is None:
+            break
+        data, errors = pair
+        with profiler.stage('reduce'):
+            for i, extractor in enumerate(extractors):
+                partial[i].append(extractor.extract(data, errors))
+
+    results = []
+    for i, extractor in enumerate(extractors):
+        if len(partial[i]) == 1:
+            extractor_results = partial[i][0]
+        else:
+            extractor_results = [
+                (numpy.concatenate([block[j][0] for block in partial[i]]),
+                 None if partial[i][0][j][1] is None else numpy.concatenate([block[j][1] for block in partial[i]]))
+                for j in range(len(extractor.out_names))
+            ]
+        if extractor.finalize is not None:
+            with profiler.stage('filter'):
+                extractor_results = extractor.finalize(extractor_results)
+        results.append(extractor_results)
+    return results
 
 
-def _roi_mean(img_list_atlas_space, atlas_data, j):
+def clean_roi_signals(roi_data, tr, confounds=None):
     """
-    Average all the data in an roi.
+    Power temporal processing, batched over all rois of the (timepoints x rois) matrix
+    :param confounds: (timepoints x confounds) array regressed out along with the filtering, as
+        NiftiSpheresMasker.fit_transform does with its confounds
     """
-    return [
-        (img_list_atlas_space[i].get_data() * (atlas_data == j)).sum() / (atlas_data == j).sum()
-        for i in range(len(img_list_atlas_space))
-    ]
+    return nilearn.signal.clean(numpy.atleast_2d(roi_data), t_r=tr, confounds=confounds, **POWER_CLEANING)
 
 
-def _roi_error_propagation(img_list_atlas_space, atlas_data, j):
+def atlas_index(atlas_name, target_img, atlas_cache_dir=None, resolution=None, number_of_clusters=None,
+                similarity_measure='t', algorithm='2level', all_granularities=False):
     """
-    If X = sum(x_i)/n, i = 1,...,n
-    then dX = sqrt(sum(dx_i**2))/n, i=1,...,n
+    The LabelIndex (PartitionIndex of all craddock granularities) of a label atlas on the grid of
+    target_img. On the atlas grid it comes from the compiled bundle, otherwise it is built once and
+    memory-mapped from atlas_cache_dir by every process after that.
     """
-    return [
-        numpy.sqrt(numpy.power(img_list_atlas_space[i].get_data() * (atlas_data == j), 2.0).sum()) / float(
-            sum(atlas_data == j))
-        for i in range(len(img_list_atlas_space))
-    ]
+    all_granularities = atlas_name == 'craddock' and all_granularities
+    identity = atlas_identity(
+        atlas_name,
+        resolution=resolution,
+        number_of_clusters=None if all_granularities else number_of_clusters,
+        similarity_measure=similarity_measure,
+        algorithm=algorithm
+    )
+    if all_granularities:
+        atlas = load_craddock_2011_all(similarity_measure=similarity_measure, algorithm=algorithm)
+    else:
+        atlas, _ = load_atlas(atlas_name, resolution=resolution, number_of_clusters=number_of_clusters,
+                              similarity_measure=similarity_measure, algorithm=algorithm)
+        if same_grid(atlas, target_img):
+            label_index = load_label_index(atlas_name, resolution=resolution, number_of_clusters=number_of_clusters,
+                                           similarity_measure=similarity_measure, algorithm=algorithm)
+            if label_index is not None:
+                return label_index
+
+    cache = ResampledAtlasCache(atlas_cache_dir)
+
+    def build():
+        resampled = cache.resample(atlas, target_img, identity)
+        if all_granularities:
+            index = PartitionIndex.from_img(resampled)
+            return dict(voxels=index.partition.voxels, cell_ids=index.partition.label_ids,
+                        cell_labels=index.cell_labels)
+        index = LabelIndex.from_img(resampled)
+        return dict(labels=index.labels, voxels=index.voxels, label_ids=index.label_ids)
+
+    arrays = cache.shared_arrays(identity, target_img, 'partition_index' if all_granularities else 'label_index',
+                                 build)
+    if all_granularities:
+        return PartitionIndex(LabelIndex(numpy.arange(len(arrays['cell_labels'])), arrays['voxels'],
+                                         arrays['cell_ids'], target_img.shape, target_img.affine),
+                              arrays['cell_labels'])
+    return LabelIndex(arrays['labels'], arrays['voxels'], arrays['label_ids'], target_img.shape, target_img.affine)
+
+
+def sphere_index(target_img, atlas_cache_dir=None, radius=None, overlap='error', smoothing_fwhm=POWER_SMOOTHING_FWHM):
+    """
+    The SphereIndex of the power seeds on the grid of target_img, with the smoothing folded into
+    its weights. Like the label indices it is built once and memory-mapped from atlas_cache_dir
+    by every process after that.
+    """
+    seeds, _ = load_atlas('power')
+
+    def build():
+        index = get_sphere_index(seeds, target_img.shape, target_img.affine, radius=radius, overlap=overlap,
+                                 smoothing_fwhm=smoothing_fwhm)
+        return dict(data=index.matrix.data, indices=index.matrix.indices, indptr=index.matrix.indptr,
+                    voxels=index.voxels)
+
+    identity = 'power_radius-%s_overlap-%s_fwhm-%s' % (radius, overlap, smoothing_fwhm)
+    arrays = ResampledAtlasCache(atlas_cache_dir).shared_arrays(identity, target_img, 'sphere_index', build)
+    matrix = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                               shape=(len(arrays['indptr']) - 1, len(arrays['voxels'])))
+    return SphereIndex(matrix, arrays['voxels'], target_img.shape, target_img.affine)
 
 
 class AtlasTransform(SimpleInterface):
@@ -61,44 +217,250 @@ class AtlasTransform(SimpleInterface):
     output_spec = AtlasTransformOutputSpec
 
     def _run_interface(self, runtime):
-        """Load the atlas and make the atlas name for the output file"""
-        if self.inputs.atlas_name == 'shen':
-            atlas = load_shen_268(resolution=self.inputs.resolution)
-            atlas_name = self.inputs.atlas_name
-        elif self.inputs.atlas_name == 'power':
-            atlas = load_power()
-            atlas_name = self.inputs.atlas_name
-        elif self.inputs.atlas_name == 'craddock':
-            atlas = load_craddock_2011(
-                number_of_clusters=self.inputs.number_of_clusters,
-                algorithm=self.inputs.algorithm,
-                similarity_measure=self.inputs.similarity_measure
-            )
-            atlas_name = "%s_%d" % (self.inputs.atlas_name, self.inputs.number_of_clusters)
-        else:
-            raise RuntimeError("Atlas name %s not recognized" % self.inputs.atlas_name)
-
         if type(self.inputs.nifti) == list:
             self.inputs.nifti = self.inputs.nifti[0]
-        source_img = nibabel.load(self.inputs.nifti)
+        outputs = self._transform(
+            self.inputs.nifti,
+            self.inputs.uncertainty if isdefined(self.inputs.uncertainty) else None,
+            self.inputs.manifest_keys if isdefined(self.inputs.manifest_keys) else None
+        )
+        for name, value in outputs.items():
+            if value:
+                self._results[name] = value
+        return runtime
+
+    def _transform(self, nifti, uncertainty=None, manifest_keys=None) -> dict:
+        """
+        Read the source image once and extract every requested atlas from it
+        :return: the transformed and confidence_intervals files, the group_shard and the profile of nifti
+        """
+        atlas_names = self.inputs.atlas_name
+        if not isinstance(atlas_names, list):
+            atlas_names = [atlas_names]
+        profiler = StageProfiler() if self.inputs.profile else NULL_PROFILER
+
+        source_path = nifti
+        if isdefined(self.inputs.cache_dir):
+            with profiler.stage('cache'):
+                source_path = BoldCache(self.inputs.cache_dir, self.inputs.cache_size_gb).get(source_path)
+        source_img = nibabel.load(source_path, mmap=True, keep_file_open=True)
         source_dimensions = len(source_img.shape)  # 4D or 3D
-        if not self.inputs.atlas_name == 'power':
+        block_size = self._block_size(source_img)
+        if not block_size:
+            # keep the decoded (or memory-mapped) array so additional atlases don't inflate the file again
+            with profiler.stage('read'):
+                source_img = nibabel.Nifti1Image(numpy.asanyarray(source_img.dataobj), source_img.affine,
+                                                 source_img.header)
+
+        error_img = None
+        if uncertainty is not None:
+            error_img = nibabel.load(uncertainty, keep_file_open=True)
+            if error_img.shape != source_img.shape:
+                raise RuntimeError("Uncertainty map %s has shape %s but %s has shape %s" % (
+                    uncertainty, str(error_img.shape), nifti, str(source_img.shape)))
+
+        with profiler.stage('atlas'):
+            extractors = [self._extractor(atlas_name, source_img, error_img is not None, block_size)
+                          for atlas_name in atlas_names]
+        results = _extract(extractors, source_img, error_img, block_size, profiler)
+
+        named_results = [(out_name, roi_data, ci_data)
+                         for extractor, extractor_results in zip(extractors, results)
+                         for out_name, (roi_data, ci_data) in zip(extractor.out_names, extractor_results)]
+
+        outputs = dict(transformed=[], confidence_intervals=[], group_shard=None, profile=None)
+        if isdefined(self.inputs.group_store):
+            with profiler.stage('group_store'):
+                outputs['group_shard'] = write_shard(self.inputs.group_store, nifti, named_results,
+                                                     precision=self.inputs.precision)
+        atlas_outputs = [[] for _ in extractors]
+        if isdefined(self.inputs.group_store):
+            # the shard is merged (and removed) at the end of the run, so the manifest points at the
+            # merged store; without it an extraction only kept in the store would never run again
+            atlas_outputs = [[str(Path(self.inputs.group_store) / GROUP_STORE_FILE)] for _ in extractors]
+        if self.inputs.write_files:
+            with profiler.stage('write'):
+                for i, (extractor, extractor_results) in enumerate(zip(extractors, results)):
+                    for out_name, (roi_data, ci_data) in zip(extractor.out_names, extractor_results):
+                        outputs['transformed'].append(self._write(roi_data, out_name, source_dimensions, nifti))
+                        atlas_outputs[i].append(outputs['transformed'][-1])
+                        if ci_data is not None:
+                            outputs['confidence_intervals'].append(
+                                self._write(ci_data, out_name + '_ci', source_dimensions, nifti))
+                            atlas_outputs[i].append(outputs['confidence_intervals'][-1])
+
+        if isdefined(self.inputs.manifest_dir) and manifest_keys is not None:
+            for atlas_name, atlas_files in zip(atlas_names, atlas_outputs):
+                record(self.inputs.manifest_dir, nifti, atlas_name, manifest_keys[atlas_name], atlas_files)
+
+        if self.inputs.profile:
+            report = profiler.report(source=str(nifti), atlas_names=atlas_names, shape=list(source_img.shape),
+                                     engine=self.inputs.engine, block_size=block_size)
+            outputs['profile'] = self._derivative_path(nifti, '_profile.json')
+            write_profile(outputs['profile'], report)
+            if isdefined(self.inputs.profile_dir):
+                record_profile(self.inputs.profile_dir, report)
+
+        return outputs
+
+    def _block_size(self, source_img):
+        """Number of volumes read at a time, 0 to read the whole image"""
+        if len(source_img.shape) != 4:
+            return 0
+        block_size = self.inputs.block_size if isdefined(self.inputs.block_size) else 0
+        if not block_size and self.inputs.low_mem:
+            block_size = LOW_MEM_BLOCK_SIZE
+        return block_size if 0 < block_size < source_img.shape[3] else 0
+
+    def _extractor(self, atlas_name, source_img, with_errors, block_size):
+        atlas_cache_dir = self.inputs.atlas_cache_dir if isdefined(self.inputs.atlas_cache_dir) else None
+        if atlas_name == 'craddock' and self.inputs.all_granularities:
+            # all cluster sizes at once; always uses the native engine
+            return _Extractor(["craddock_%d" % number_of_clusters for number_of_clusters in CRADDOCK_CLUSTER_SIZES],
+                              self._atlas_index(atlas_name, source_img, all_granularities=True).extract)
+
+        atlas, out_name = load_atlas(
+            atlas_name,
+            resolution=self.inputs.resolution,
+            number_of_clusters=self.inputs.number_of_clusters,
+            similarity_measure=self.inputs.similarity_measure,
+            algorithm=self.inputs.algorithm
+        )
+        if not atlas_name == 'power':
+            # error propagation comes out of the same pass as the means and streamed blocks are
+            # reduced in place, so both always use the label index
+            if self.inputs.engine == 'native' or with_errors or block_size:
+                return _Extractor([out_name], self._atlas_index(atlas_name, source_img).extract)
+            atlas = ResampledAtlasCache(atlas_cache_dir).resample(atlas, source_img, atlas_identity(
+                atlas_name,
+                resolution=self.inputs.resolution,
+                number_of_clusters=self.inputs.number_of_clusters,
+                similarity_measure=self.inputs.similarity_measure,
+                algorithm=self.inputs.algorithm
+            ))
             masker = nilearn.input_data.NiftiLabelsMasker(atlas)
-            roi_data = masker.fit_transform(source_img)
+            return _Extractor([out_name], lambda data, errors: [(masker.fit_transform(
+                nibabel.Nifti1Image(data, source_img.affine, source_img.header)), None)])
+
+        if with_errors:
+            LOGGER.warning('Uncertainty maps are not propagated for the power atlas')
+        tr = source_img.header.get('pixdim')[4]
+        radius = self.inputs.sphere_radius if isdefined(self.inputs.sphere_radius) else None
+        if self.inputs.engine == 'native':
+            # smoothing is folded into the sphere weights instead of smoothing the whole volume
+            index = self._sphere_index(source_img, radius)
+
+            def extract(data, errors):
+                return [(index.transform(data), None)]
         else:
-            tr = source_img.header.get('pixdim')[4]
-            masker = nilearn.input_data.NiftiSpheresMasker(atlas, detrend=True, standardize=True,
-                                                           low_pass=0.08, high_pass=0.009, smoothing_fwhm=6, t_r=tr)
-            roi_data = masker.fit_transform(source_img)
-        suffix = "_%s.csv" % atlas_name
-        if source_dimensions == 4:
-            suffix = suffix.replace('.csv', '_ts.csv')  # 4D images get the ts suffix for time-series
+            if self.inputs.sphere_overlap == 'nearest':
+                LOGGER.warning("The 'nearest' sphere overlap policy needs the native engine, overlap is allowed "
+                               "instead")
+            # spatial steps only, the masker would otherwise clean the sphere signals itself
+            masker = nilearn.input_data.NiftiSpheresMasker(atlas, radius=radius,
+                                                           allow_overlap=self.inputs.sphere_overlap != 'error',
+                                                           smoothing_fwhm=POWER_SMOOTHING_FWHM)
+
+            def extract(data, errors):
+                return [(masker.fit_transform(nibabel.Nifti1Image(data, source_img.affine, source_img.header)),
+                         None)]
+
+        # detrending, band-pass filtering and standardization are temporal and commute with the
+        # spatial averaging (standardization is applied to the sphere signals either way, as in
+        # NiftiSpheresMasker), so they run once on the (timepoints x spheres) matrix after all
+        # blocks have been reduced
+        return _Extractor([out_name], extract,
+                          lambda results: [(clean_roi_signals(results[0][0], tr), None)])
+
+    def _sphere_index(self, source_img, radius):
+        """sphere_index, reused by every run of the node that is on the same grid"""
+        key = ('power', radius, tuple(source_img.shape[:3]),
+               numpy.round(numpy.asarray(source_img.affine, dtype=numpy.float64), 6).tobytes())
+        if not hasattr(self, '_atlas_indices'):
+            self._atlas_indices = {}
+        if key not in self._atlas_indices:
+            self._atlas_indices[key] = sphere_index(
+                source_img,
+                atlas_cache_dir=self.inputs.atlas_cache_dir if isdefined(self.inputs.atlas_cache_dir) else None,
+                radius=radius,
+                overlap=self.inputs.sphere_overlap
+            )
+        return self._atlas_indices[key]
+
+    def _atlas_index(self, atlas_name, source_img, all_granularities=False):
+        """atlas_index, reused by every run of the node that is on the same grid"""
+        key = (atlas_name, all_granularities, tuple(source_img.shape[:3]),
+               numpy.round(numpy.asarray(source_img.affine, dtype=numpy.float64), 6).tobytes())
+        if not hasattr(self, '_atlas_indices'):
+            self._atlas_indices = {}
+        if key not in self._atlas_indices:
+            self._atlas_indices[key] = atlas_index(
+                atlas_name, source_img,
+                atlas_cache_dir=self.inputs.atlas_cache_dir if isdefined(self.inputs.atlas_cache_dir) else None,
+                resolution=self.inputs.resolution,
+                number_of_clusters=self.inputs.number_of_clusters,
+                similarity_measure=self.inputs.similarity_measure,
+                algorithm=self.inputs.algorithm,
+                all_granularities=all_granularities
+            )
+        return self._atlas_indices[key]
 
-        out_file = fname_presuffix(self.inputs.nifti, suffix=suffix, use_ext=False).replace(
+    def _derivative_path(self, nifti, suffix):
+        """path of a derivative of nifti, its folder is created"""
+        out_file = fname_presuffix(nifti, suffix=suffix, use_ext=False).replace(
             Path(self.inputs.bids_dir).stem, __name__.split('.')[0])
         os.makedirs(Path(out_file).parent, exist_ok=True)
-        numpy.savetxt(out_file, roi_data, delimiter=',')
+        return out_file
+
+    def _write(self, roi_data, out_name, source_dimensions, nifti):
+        suffix = "_%s" % out_name
+        if source_dimensions == 4:
+            suffix += '_ts'  # 4D images get the ts suffix for time-series
+        suffix += OUTPUT_EXTENSIONS[self.inputs.output_format]
+
+        out_file = self._derivative_path(nifti, suffix)
+        write_roi_data(out_file, roi_data, output_format=self.inputs.output_format, precision=self.inputs.precision)
+        return out_file
+
+
+class AtlasTransformBatchInputSpec(AtlasTransformInputSpec):
+    nifti = traits.List(traits.Any, mandatory=True, desc='input niftis (e.g. all runs of a subject)')
+    uncertainty = traits.List(traits.Any, mandatory=False,
+                              desc='uncertainty map of every nifti (None for niftis without one)')
+    manifest_keys = traits.List(traits.Dict(traits.String, traits.String), mandatory=False,
+                                desc='extraction key of every atlas name, for every nifti')
 
-        self._results['transformed'] = out_file
 
+class AtlasTransformBatchOutputSpec(AtlasTransformOutputSpec):
+    group_shard = OutputMultiObject(File(exists=True), desc='group store shard of every nifti')
+    profile = OutputMultiObject(File(exists=True), desc='stage profile of every nifti')
+
+
+class AtlasTransformBatch(AtlasTransform):
+    """
+    AtlasTransform of several niftis in one node; the atlases, their resampling and the voxel
+    indices are loaded once and reused by every nifti on the same grid
+    """
+    input_spec = AtlasTransformBatchInputSpec
+    output_spec = AtlasTransformBatchOutputSpec
+
+    def _run_interface(self, runtime):
+        niftis = self.inputs.nifti
+        uncertainties = self.inputs.uncertainty if isdefined(self.inputs.uncertainty) else [None] * len(niftis)
+        manifest_keys = self.inputs.manifest_keys if isdefined(self.inputs.manifest_keys) else [None] * len(niftis)
+        if not len(niftis) == len(uncertainties) == len(manifest_keys):
+            raise RuntimeError("Got %d niftis, %d uncertainty maps and %d manifest keys" % (
+                len(niftis), len(uncertainties), len(manifest_keys)))
+
+        batch_outputs = dict(transformed=[], confidence_intervals=[], group_shard=[], profile=[])
+        for nifti, uncertainty, keys in zip(niftis, uncertainties, manifest_keys):
+            outputs = self._transform(nifti, uncertainty, keys)
+            batch_outputs['transformed'].extend(outputs['transformed'])
+            batch_outputs['confidence_intervals'].extend(outputs['confidence_intervals'])
+            for name in ['group_shard', 'profile']:
+                if outputs[name] is not None:
+                    batch_outputs[name].append(outputs[name])
+        for name, value in batch_outputs.items():
+            if value:
+                self._results[name] = value
         return runtime
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+The native label index gives the roi data of NiftiLabelsMasker, and extracting all craddock
+granularities in one pass gives those of every granularity extracted on its own
+"""
+import numpy
+import pytest
+
+from ..benchmarks.synthetic import make_synthetic_dataset
+from ..interfaces import AtlasTransform
+from ..utils.constants import CRADDOCK_CLUSTER_SIZES
+from ..utils.output import read_roi_data
+
+CASES = {
+    'shen': dict(atlas_name='shen', resolution=2),
+    'craddock_200': dict(atlas_name='craddock', number_of_clusters=200),
+}
+
+
+@pytest.fixture(scope='module')
+def dataset(tmp_path_factory):
+    """a 4D bold series and a 3D float32 hurst map on the MNI 3mm grid, which every atlas is resampled to"""
+    bids_dir = tmp_path_factory.mktemp('labels') / 'bids'
+    subject_data = make_synthetic_dataset(bids_dir, 1, 1, grid='3mm', n_volumes=10)['001']
+    return dict(bids_dir=str(bids_dir), bold=subject_data['bold'][0], hurst=subject_data['hurst'][0])
+
+
+def _roi_data(dataset, source, **inputs) -> list:
+    interface = AtlasTransform(bids_dir=dataset['bids_dir'], similarity_measure='t', algorithm='2level',
+                               output_format='npy', **inputs)
+    return [read_roi_data(out_file) for out_file in interface._transform(dataset[source])['transformed']]
+
+
+@pytest.mark.parametrize('source', ['bold', 'hurst'])
+@pytest.mark.parametrize('case', list(CASES))
+def test_native_matches_nilearn(dataset, case, source):
+    native, = _roi_data(dataset, source, engine='native', **CASES[case])
+    nilearn, = _roi_data(dataset, source, engine='nilearn', **CASES[case])
+
+    assert native.shape == nilearn.shape
+    # float32 3D maps are averaged in float64 by the native engine, in float32 by nilearn
+    numpy.testing.assert_allclose(native, nilearn, rtol=1e-6, atol=0)
+
+
+@pytest.mark.parametrize('source', ['bold', 'hurst'])
+def test_all_granularities_match_single_granularities(dataset, source):
+    all_granularities = _roi_data(dataset, source, engine='native', atlas_name='craddock', all_granularities=True)
+
+    assert len(all_granularities) == len(CRADDOCK_CLUSTER_SIZES)
+    for number_of_clusters, roi_data in zip(CRADDOCK_CLUSTER_SIZES, all_granularities):
+        single, = _roi_data(dataset, source, engine='native', atlas_name='craddock',
+                            number_of_clusters=number_of_clusters)
+        numpy.testing.assert_allclose(roi_data, single, rtol=1e-12, atol=0,
+                                      err_msg='craddock_%d' % number_of_clusters)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+The Power sphere signals of AtlasTransform (smoothing folded into the sphere weights or done by the
+masker, optionally streamed in blocks, cleaned once on the roi matrix) match a NiftiSpheresMasker
+that smooths, extracts and cleans the whole series itself
+"""
+import nibabel
+import numpy
+import pytest
+from nilearn.input_data import NiftiSpheresMasker
+
+from ..benchmarks.synthetic import GRIDS, SPACE
+from ..interfaces import AtlasTransform
+from ..interfaces.atlasTransform import POWER_CLEANING, POWER_SMOOTHING_FWHM
+from ..utils.atlas import load_atlas
+from ..utils.output import read_roi_data
+
+TR = 2.0
+N_VOLUMES = 48
+RADIUS = 5.
+
+
+@pytest.fixture(scope='module')
+def bold_file(tmp_path_factory):
+    shape, affine = GRIDS['3mm']
+    rng = numpy.random.default_rng(0)
+    time = numpy.arange(N_VOLUMES) * TR
+    data = rng.uniform(500, 1500, size=shape + (1,)) + rng.standard_normal(shape + (N_VOLUMES,)) * 20
+    # a slow drift and an oscillation inside the pass band, so detrending and filtering both matter
+    data += 0.5 * time + 30 * numpy.sin(2 * numpy.pi * 0.03 * time)
+    img = nibabel.Nifti1Image(data.astype(numpy.float32), affine)
+    img.header.set_xyzt_units('mm', 'sec')
+    img.header['pixdim'][4] = TR
+    func = tmp_path_factory.mktemp('power') / 'bids' / 'sub-01' / 'func'
+    func.mkdir(parents=True)
+    bold_file = func / ('sub-01_task-rest_space-%s_desc-preproc_bold.nii.gz' % SPACE)
+    img.to_filename(str(bold_file))
+    return bold_file
+
+
+@pytest.fixture(scope='module')
+def expected(bold_file):
+    seeds, _ = load_atlas('power')
+    masker = NiftiSpheresMasker(seeds, radius=RADIUS, allow_overlap=True, smoothing_fwhm=POWER_SMOOTHING_FWHM,
+                                t_r=TR, **POWER_CLEANING)
+    return masker.fit_transform(str(bold_file))
+
+
+@pytest.mark.parametrize('block_size', [0, 20], ids=['whole_series', 'streamed'])
+@pytest.mark.parametrize('engine', ['nilearn', 'native'])
+def test_power_matches_cleaning_masker(bold_file, expected, engine, block_size):
+    inputs = dict(block_size=block_size) if block_size else {}
+    interface = AtlasTransform(atlas_name='power', engine=engine, sphere_radius=RADIUS, sphere_overlap='allow',
+                               bids_dir=str(bold_file.parents[2]), output_format='npy', **inputs)
+    outputs = interface._transform(str(bold_file))
+    roi_data = read_roi_data(outputs['transformed'][0])
+
+    assert roi_data.shape == expected.shape == (N_VOLUMES, 264)
+    # standardized signals; nilearn smooths in float32, the native sphere weights are float64 (~1e-5 apart)
+    numpy.testing.assert_allclose(roi_data, expected, rtol=0, atol=1e-4)
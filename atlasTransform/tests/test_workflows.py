@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Workflow construction"""
+import pytest
+
+from ..cli.run_utils import get_parser
+from ..workflows.base import init_single_subject_wf
+
+
+@pytest.mark.parametrize('batch_runs', [0, 2], ids=['nodes', 'batched'])
+def test_documentation_workflow(tmp_path, batch_runs):
+    """The documentation workflow is built on placeholder inputs that do not exist"""
+    opts = get_parser().parse_args([str(tmp_path / 'bids'), str(tmp_path / 'out'), 'participant', 'shen', 'power',
+                                    '-w', str(tmp_path / 'work'), '--batch-runs', str(batch_runs)])
+    workflow = init_single_subject_wf(opts=opts, layout=None, run_uuid='test', work_dir=str(tmp_path / 'work'),
+                                      output_dir=str(tmp_path / 'out'), name='single_subject_wf', subject_id='01',
+                                      reportlets_dir=str(tmp_path / 'work' / 'reportlets'))
+    assert any(name.startswith('atlas_transform_') and name.endswith('.transform')
+               for name in workflow.list_node_names())
+    assert not (tmp_path / 'work' / 'atlas_cache').exists()
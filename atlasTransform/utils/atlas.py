@@ -7,18 +7,20 @@ Utilities to load atlases
 ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
 """
 import os
+from collections import OrderedDict
 from pathlib import Path
 
 import nibabel
 import numpy
 from nipype import logging
 
+from .bundle import load_bundle
+from .constants import CRADDOCK_CLUSTER_SIZES
+
 LOGGER = logging.getLogger('nipype.interface')
 
-CRADDOCK_CLUSTER_SIZES = [
-    10,20,30,40,50,60,70,80,90,100,110,120,130,140,150,160,170,180,190,200,210,220,230,240,250,260,270,280,290,300,
-    350,400,450,500,550,600,650,700,750,800,850,900,950
-]
+MAX_CACHED_CRADDOCK_VOLUMES = 8  # granularities kept per process by load_craddock_2011
+_CRADDOCK_VOLUMES = OrderedDict()
 
 
 def __get_data_folder_path():
@@ -33,17 +35,19 @@ def load_shen_268(resolution: int) -> nibabel.Nifti1Image:
     if not [1,2].__contains__(resolution):
         raise RuntimeError("%d is not a valid resolution for the shen atlas. Please use 1mm or 2mm" % resolution)
 
+    bundle = load_bundle(atlas_identity('shen', resolution=resolution))
+    if bundle is not None:
+        return bundle.image()
     atlas_path = os.path.join(__get_data_folder_path(), 'shen_268', 'shen_%dmm_268_parcellation.nii.gz' % resolution)
     return nibabel.load(atlas_path)
 
 
-def load_power() -> list:
+def load_power() -> numpy.ndarray:
     """
-    :return:
+    :return: (264 x 3) MNI coordinates of the power seeds
     """
-    atlas_path = os.path.join(__get_data_folder_path(), 'power_2011', 'power_dict.npy')
-    atlas = numpy.load(atlas_path, allow_pickle=True).item()
-    coords = numpy.vstack((atlas.rois['x'], atlas.rois['y'], atlas.rois['z'])).T
+    atlas_path = os.path.join(__get_data_folder_path(), 'power_2011', 'power_coords.npy')
+    coords = numpy.load(atlas_path)
 
     # atlas_path = os.path.join(__get_data_folder_path(), 'power_2011', 'power_order.npy')
     # atlas =  numpy.load(atlas_path,allow_pickle=True).tolist()
@@ -59,16 +63,112 @@ def load_craddock_2011(number_of_clusters: int, similarity_measure: str = 't', a
     :param algorithm: 2level, mean, none
     :return:
     """
+    if not CRADDOCK_CLUSTER_SIZES.__contains__(number_of_clusters):
+        raise RuntimeError("%d is not a valid cluster size for the craddock atlases. Please use one of %s" % (number_of_clusters, str(CRADDOCK_CLUSTER_SIZES)))
+
+    key = (number_of_clusters, similarity_measure, algorithm)
+    if key in _CRADDOCK_VOLUMES:
+        _CRADDOCK_VOLUMES.move_to_end(key)
+        return _CRADDOCK_VOLUMES[key]
+
+    bundle = load_bundle(atlas_identity('craddock', similarity_measure=similarity_measure, algorithm=algorithm))
+    if bundle is not None:
+        atlas = bundle.volume(CRADDOCK_CLUSTER_SIZES.index(number_of_clusters))
+    else:
+        dataset_img = load_craddock_2011_all(similarity_measure=similarity_measure, algorithm=algorithm)
+        # slice the proxy, so only this volume is read (and nothing is split into 43 images)
+        atlas = nibabel.Nifti1Image(dataset_img.dataobj[..., CRADDOCK_CLUSTER_SIZES.index(number_of_clusters)],
+                                    dataset_img.affine, dataset_img.header)
+
+    _CRADDOCK_VOLUMES[key] = atlas
+    if len(_CRADDOCK_VOLUMES) > MAX_CACHED_CRADDOCK_VOLUMES:
+        _CRADDOCK_VOLUMES.popitem(last=False)
+    return atlas
+
+
+def load_craddock_2011_all(similarity_measure: str = 't', algorithm='2level') -> nibabel.Nifti1Image:
+    """
+    :param similarity_measure: t, s, or random (temporal, spatial, random)
+    :param algorithm: 2level, mean, none
+    :return: 4D image with one volume per entry of CRADDOCK_CLUSTER_SIZES
+    """
     if not ["t", "s", "random"].__contains__(similarity_measure):
         raise RuntimeError("%s is not a valid similarity measure for the craddock atlases. Please use 't', 's', 'random'" % similarity_measure)
     if not ["2level", "mean", None].__contains__(algorithm):
         raise RuntimeError(
             "%s is not a valid algorithm type for the craddock atlases. Please use '2level', 'mean', or None" % similarity_measure)
-    if not CRADDOCK_CLUSTER_SIZES.__contains__(number_of_clusters):
-        raise RuntimeError("%d is not a valid cluster size for the craddock atlases. Please use one of %s" % (number_of_clusters, str(CRADDOCK_CLUSTER_SIZES)))
 
+    bundle = load_bundle(atlas_identity('craddock', similarity_measure=similarity_measure, algorithm=algorithm))
+    if bundle is not None:
+        return bundle.image()
     algorithm = algorithm + '_' if algorithm is not None else ''
     dataset_path = os.path.join(__get_data_folder_path(), 'craddock_2011', '%scorr05_%sall.nii.gz' % (similarity_measure, algorithm))
-    dataset_img = nibabel.load(dataset_path)
+    return nibabel.load(dataset_path)
 
-    return nibabel.four_to_three(dataset_img)[CRADDOCK_CLUSTER_SIZES.index(number_of_clusters)]
+
+def load_atlas(atlas_name: str, resolution: int = None, number_of_clusters: int = None,
+               similarity_measure: str = 't', algorithm='2level'):
+    """
+    :param atlas_name: shen, power, or craddock
+    :return: the atlas and the name used for its output files
+    """
+    if atlas_name == 'shen':
+        return load_shen_268(resolution=resolution), atlas_name
+    if atlas_name == 'power':
+        return load_power(), atlas_name
+    if atlas_name == 'craddock':
+        atlas = load_craddock_2011(
+            number_of_clusters=number_of_clusters,
+            algorithm=algorithm,
+            similarity_measure=similarity_measure
+        )
+        return atlas, "%s_%d" % (atlas_name, number_of_clusters)
+    raise RuntimeError("Atlas name %s not recognized" % atlas_name)
+
+
+def atlas_identity(atlas_name: str, resolution: int = None, number_of_clusters: int = None,
+                   similarity_measure: str = 't', algorithm='2level') -> str:
+    """
+    :return: a name that uniquely identifies the atlas image load_atlas returns for these parameters
+     (number_of_clusters=None stands for the 4D image of all craddock granularities)
+    """
+    if atlas_name == 'shen':
+        return 'shen_%dmm' % resolution
+    if atlas_name == 'craddock':
+        return 'craddock_%scorr05_%s_%s' % (similarity_measure, algorithm,
+                                            'all' if number_of_clusters is None else number_of_clusters)
+    return atlas_name
+
+
+def load_label_index(atlas_name: str, resolution: int = None, number_of_clusters: int = None,
+                     similarity_measure: str = 't', algorithm='2level'):
+    """
+    :return: the precompiled LabelIndex of the atlas on its own grid, None if it has no compiled bundle
+    """
+    if atlas_name == 'shen':
+        bundle = load_bundle(atlas_identity(atlas_name, resolution=resolution))
+        return bundle.label_index() if bundle is not None else None
+    if atlas_name == 'craddock':
+        bundle = load_bundle(atlas_identity(atlas_name, similarity_measure=similarity_measure, algorithm=algorithm))
+        return bundle.label_index(CRADDOCK_CLUSTER_SIZES.index(number_of_clusters)) if bundle is not None else None
+    return None
+
+
+def compile_atlases(bundle_dir=None) -> list:
+    """
+    Compile every shen and craddock atlas image into a bundle (see utils.bundle).
+    :return: paths of the bundles
+    """
+    from .bundle import compile_bundle
+    paths = []
+    for resolution in [1, 2]:
+        atlas_path = os.path.join(__get_data_folder_path(), 'shen_268',
+                                  'shen_%dmm_268_parcellation.nii.gz' % resolution)
+        paths.append(compile_bundle(nibabel.load(atlas_path), atlas_identity('shen', resolution=resolution),
+                                    bundle_dir=bundle_dir))
+    for similarity_measure, algorithm in [('t', '2level'), ('t', 'mean'), ('s', '2level'), ('s', 'mean')]:
+        dataset_path = os.path.join(__get_data_folder_path(), 'craddock_2011',
+                                    '%scorr05_%s_all.nii.gz' % (similarity_measure, algorithm))
+        paths.append(compile_bundle(nibabel.load(dataset_path), atlas_identity(
+            'craddock', similarity_measure=similarity_measure, algorithm=algorithm), bundle_dir=bundle_dir))
+    return paths
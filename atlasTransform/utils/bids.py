@@ -8,6 +8,7 @@ Utilities to handle BIDS inputs
 """
 
 import os
+import re
 import sys
 import json
 from pathlib import Path
@@ -21,6 +22,16 @@ from niworkflows.interfaces.bids import BIDSDataGrabber
 
 LOGGER = logging.getLogger('nipype.interface')
 
+LAYOUT_IGNORE = ("code", "stimuli", "sourcedata", "models", "derivatives", re.compile(r'^\.'))
+LAYOUT_DB_DIR = 'bids_db'
+LAYOUT_SNAPSHOT_FILE = 'directories.json'
+SOURCE_QUERIES = {
+    'bold': {'datatype': 'func', 'suffix': 'bold'},
+    'hurst': {'suffix': 'hurst'},
+}
+INVENTORY_SOURCES = list(SOURCE_QUERIES)
+_SUBJECT_PATTERN = re.compile(r'(?:^|_)sub-([a-zA-Z0-9]+)')
+
 
 def write_derivative_description(bids_dir, deriv_dir):
     from ..__about__ import __version__, __url__, DOWNLOAD_URL
@@ -161,19 +172,193 @@ def _get_shub_version(singularity_url):
     return NotImplemented
 
 
-def collect_data(layout: BIDSLayout, subject_id, other_format: str = None):
-    from niworkflows.utils.bids import collect_data
-    standard_search, layout = collect_data(layout, subject_id)
-    masks = [file.split('desc')[0] +'desc-brain_mask.nii.gz' for file in standard_search['bold']]
-    standard_search['mask'] = masks
+def _new_layout(bids_dir, **kwargs) -> BIDSLayout:
+    try:
+        from bids.layout import BIDSLayoutIndexer
+    except ImportError:  # pybids < 0.14 takes the indexer options directly
+        return BIDSLayout(str(bids_dir), validate=False, ignore=LAYOUT_IGNORE, **kwargs)
+    # sidecar metadata are never queried, leaving them out of the index saves reading every json file
+    indexer = BIDSLayoutIndexer(validate=False, ignore=LAYOUT_IGNORE, index_metadata=False)
+    return BIDSLayout(str(bids_dir), validate=False, indexer=indexer, **kwargs)
+
 
-    confounds = [file.split('space')[0] + 'desc-confounds_regressors.tsv' for file in standard_search['bold']]
-    standard_search['confounds'] = confounds
+def _is_ignored(name: str, top_level: bool) -> bool:
+    return top_level and (name in LAYOUT_IGNORE or name.startswith('.'))
 
-    hurst = list(filter(lambda f: f.__contains__('hurst.nii.gz'),layout.files))
-    standard_search['hurst'] = hurst
 
-    return standard_search, layout
+def _directory_snapshot(bids_dir: Path, previous: dict) -> dict:
+    """
+    mtime of every indexed directory of bids_dir (relative path -> st_mtime_ns). Only the
+    directories whose mtime differs from previous are listed, the subdirectories of the others
+    are taken from previous, so an unchanged dataset costs one stat per directory.
+    """
+    children = {}
+    for rel in previous:
+        if rel != '.':
+            children.setdefault(os.path.dirname(rel) or '.', []).append(rel)
+
+    snapshot = {}
+    pending = ['.']
+    while pending:
+        rel = pending.pop()
+        try:
+            mtime = os.stat(str(bids_dir / rel)).st_mtime_ns
+        except FileNotFoundError:
+            continue
+        snapshot[rel] = mtime
+        if previous.get(rel) == mtime:
+            pending.extend(children.get(rel, []))
+            continue
+        with os.scandir(str(bids_dir / rel)) as entries:
+            pending.extend(os.path.normpath(os.path.join(rel, entry.name)) for entry in entries
+                           if entry.is_dir() and not _is_ignored(entry.name, rel == '.'))
+    return snapshot
+
+
+def _refresh_layout(layout: BIDSLayout, bids_dir: Path, changed: list, removed: list):
+    """
+    Index again the files directly inside the changed directories and drop the files of the
+    removed ones, instead of walking the whole dataset.
+    """
+    from bids.layout import BIDSLayoutIndexer
+    from bids.layout.models import BIDSFile, Tag
+
+    session = layout.connection_manager.session
+    indexer = BIDSLayoutIndexer(validate=False, ignore=LAYOUT_IGNORE, index_metadata=False)
+    entities = {}
+    for config in layout.config.values():
+        entities.update(config.entities)
+
+    stale = []
+    for rel in removed:
+        stale += [path for path, in session.query(BIDSFile.path).filter(BIDSFile.dirname == str(bids_dir / rel))]
+    new_files, new_tags = [], []
+    for rel in changed:
+        directory = bids_dir / rel
+        indexed = {path for path, in session.query(BIDSFile.path).filter(BIDSFile.dirname == str(directory))}
+        with os.scandir(str(directory)) as entries:
+            present = {str(directory / entry.name) for entry in entries
+                       if not entry.is_dir() and not _is_ignored(entry.name, rel == '.')}
+        stale += indexed - present
+        for path in sorted(present - indexed):
+            bids_file, tags = indexer._index_file(layout._root / os.path.relpath(path, str(bids_dir)), entities)
+            new_files.append(bids_file)
+            new_tags += tags
+
+    for chunk in range(0, len(stale), 500):
+        paths = stale[chunk:chunk + 500]
+        session.query(Tag).filter(Tag.file_path.in_(paths)).delete(synchronize_session=False)
+        session.query(BIDSFile).filter(BIDSFile.path.in_(paths)).delete(synchronize_session=False)
+    session.bulk_save_objects(new_files)
+    session.bulk_insert_mappings(Tag, new_tags)
+    session.commit()
+    LOGGER.info('Refreshed the BIDS index: %d directories changed, %d files added, %d files removed',
+                len(changed) + len(removed), len(new_files), len(stale))
+
+
+def load_layout(bids_dir, database_dir=None, reindex: bool = False) -> BIDSLayout:
+    """
+    The layout of the input dataset, leaving out folders that hold no inputs.
+
+    :param database_dir: keep the index in this folder across runs (the dataset is indexed from
+        scratch on every call if None). Later calls only stat the directories of the dataset and
+        index again the ones whose mtime changed.
+    :param reindex: index the whole dataset again even if database_dir holds an index
+    """
+    bids_dir = Path(bids_dir).resolve()
+    if database_dir is None:
+        return _new_layout(bids_dir)
+
+    database_dir = Path(database_dir)
+    snapshot_file = database_dir / LAYOUT_SNAPSHOT_FILE
+    previous = {}
+    if not reindex and snapshot_file.exists():
+        with snapshot_file.open() as fobj:
+            recorded = json.load(fobj)
+        if recorded.get('root') == str(bids_dir):
+            previous = recorded['directories']
+
+    snapshot = _directory_snapshot(bids_dir, previous)
+    layout = None
+    if previous:
+        changed = [rel for rel, mtime in snapshot.items() if previous.get(rel) != mtime]
+        removed = [rel for rel in previous if rel not in snapshot]
+        try:
+            layout = BIDSLayout(str(bids_dir), validate=False, database_path=str(database_dir))
+            if changed or removed:
+                _refresh_layout(layout, bids_dir, changed, removed)
+            else:
+                LOGGER.info('Reusing the BIDS index in %s', database_dir)
+        except Exception as e:  # older pybids or an index it can no longer read
+            LOGGER.warning('Cannot refresh the BIDS index in %s (%s), indexing the dataset again', database_dir, e)
+            layout = None
+    if layout is None:
+        database_dir.mkdir(parents=True, exist_ok=True)
+        layout = _new_layout(bids_dir, database_path=str(database_dir), reset_database=True)
+
+    tmp = snapshot_file.with_suffix('.part')
+    with tmp.open('w') as fobj:
+        json.dump({'root': str(bids_dir), 'directories': snapshot}, fobj)
+    os.replace(str(tmp), str(snapshot_file))
+    return layout
+
+
+def _companion(source_file: str, from_entity: str, replacement: str) -> str:
+    """source_file with its name cut before from_entity (or its suffix) and replacement appended"""
+    directory, name = os.path.split(source_file)
+    match = re.search(r'(?:^|_)%s-' % from_entity, name) or re.search(r'_[a-zA-Z0-9]+\.', name)
+    return os.path.join(directory, name[:match.start()] + '_' + replacement)
+
+
+def collect_inventory(layout: BIDSLayout, subject_list: list = None, task=None, session=None, run=None,
+                      space=None) -> dict:
+    """
+    Collect the inputs of every subject with one query of the layout per source type, the entity
+    filters are part of the queries.
+
+    :param subject_list: subject labels to collect (every subject if None)
+    :return: subject label -> {'bold', 'mask', 'confounds', 'hurst': sorted files}
+    """
+    filters = dict(task=task, session=session, run=run, space=space)
+    filters = {entity: value for entity, value in filters.items() if value is not None}
+    if subject_list is not None:
+        filters['subject'] = list(subject_list)
+
+    def no_data():
+        return {source: [] for source in INVENTORY_SOURCES + ['mask', 'confounds']}
+
+    inventory = {subject_id: no_data() for subject_id in subject_list or []}
+    for source in INVENTORY_SOURCES:
+        for source_file in sorted(layout.get(return_type='file', extension=['.nii', '.nii.gz'],
+                                             **SOURCE_QUERIES[source], **filters)):
+            subject_id = _SUBJECT_PATTERN.search(os.path.basename(source_file)).group(1)
+            subject_data = inventory.setdefault(subject_id, no_data())
+            subject_data[source].append(source_file)
+            if source == 'bold':
+                subject_data['mask'].append(_companion(source_file, 'desc', 'desc-brain_mask.nii.gz'))
+                subject_data['confounds'].append(_companion(source_file, 'space', 'desc-confounds_regressors.tsv'))
+    return inventory
+
+
+def collect_data(layout: BIDSLayout, subject_id, other_format: str = None):
+    """The inputs of one subject, see collect_inventory (collect them all at once for several subjects)"""
+    return collect_inventory(layout, [subject_id])[subject_id], layout
+
+
+def get_uncertainty_map(source_file: str, uncertainty_suffix: str):
+    """
+    Find the uncertainty map sitting next to source_file, i.e. the same file name with its
+    BIDS suffix replaced (sub-01_task-rest_hurst.nii.gz -> sub-01_task-rest_<uncertainty_suffix>.nii.gz).
+    :return: the path or None if there is no such file
+    """
+    source_file = Path(source_file)
+    stem = source_file.name.split('.')[0]
+    extension = source_file.name[len(stem):]
+    uncertainty_map = source_file.parent / ('%s_%s%s' % (stem.rsplit('_', 1)[0], uncertainty_suffix, extension))
+    if not uncertainty_map.exists():
+        LOGGER.warning('No uncertainty map %s found for %s', uncertainty_map, source_file)
+        return None
+    return str(uncertainty_map)
 
 
 class BIDSPlusDataGrabberOutputSpec(BIDSDataGrabberOutputSpec):
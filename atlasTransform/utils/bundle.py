@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Compiled atlas bundles
+^^^^^^^^^^^^^^^^^^^^^^
+
+A bundle is a directory of uncompressed .npy arrays that are memory-mapped on load
+(no inflating, no pickle):
+
+- labels.npy: (volumes x X x Y x Z) uint16 labels, one volume per parcellation
+- affine.npy: (4 x 4) affine of the grid
+- label_values.npy, counts.npy, centroids.npy: label values, voxel counts and centroids (mm),
+  volume v owns entries label_offsets[v]:label_offsets[v + 1] (label_offsets.npy)
+- voxels.npy, voxel_labels.npy: (Fortran order) flat index of every labelled voxel and the
+  position of its label in the volume's label_values, volume v owns entries
+  voxel_offsets[v]:voxel_offsets[v + 1] (voxel_offsets.npy)
+
+so the label index of a volume on the atlas grid is a slice instead of a scan of the image.
+Bundles are built by ``atlasTransform-compile-atlases``.
+"""
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import nibabel
+import numpy
+
+from .extraction import LabelIndex
+
+BUNDLE_FORMAT_VERSION = 1
+BUNDLE_DIR_ENV = 'ATLASTRANSFORM_ATLAS_BUNDLES'
+_ARRAYS = ['labels', 'affine', 'label_offsets', 'label_values', 'counts', 'centroids', 'voxel_offsets', 'voxels',
+           'voxel_labels']
+_BUNDLES = {}
+
+
+def default_bundle_dir() -> str:
+    """$ATLASTRANSFORM_ATLAS_BUNDLES, or the compiled folder of the package data"""
+    return os.environ.get(BUNDLE_DIR_ENV, os.path.join(Path(__file__).parent.parent, 'data', 'compiled'))
+
+
+class AtlasBundle(object):
+    """Memory-mapped arrays of a compiled atlas, see the module docstring"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with (self.path / 'meta.json').open() as fobj:
+            self.meta = json.load(fobj)
+        if self.meta.get('format_version') != BUNDLE_FORMAT_VERSION:
+            raise RuntimeError("%s was compiled with bundle format %s, please compile the atlases again" % (
+                self.path, self.meta.get('format_version')))
+        for name in _ARRAYS:
+            setattr(self, name, numpy.load(str(self.path / (name + '.npy')), mmap_mode='r', allow_pickle=False))
+
+    @property
+    def n_volumes(self) -> int:
+        return self.labels.shape[0]
+
+    def volume(self, volume: int = 0) -> nibabel.Nifti1Image:
+        """3D label image of one parcellation (a view of the memory map)"""
+        return nibabel.Nifti1Image(self.labels[volume], numpy.array(self.affine))
+
+    def image(self) -> nibabel.Nifti1Image:
+        """The compiled image, 4D if it holds several parcellations"""
+        if self.n_volumes == 1:
+            return self.volume(0)
+        return nibabel.Nifti1Image(numpy.moveaxis(self.labels, 0, -1), numpy.array(self.affine))
+
+    def label_index(self, volume: int = 0) -> LabelIndex:
+        """LabelIndex of one parcellation on the atlas grid, without scanning the labels"""
+        labels = slice(self.label_offsets[volume], self.label_offsets[volume + 1])
+        voxels = slice(self.voxel_offsets[volume], self.voxel_offsets[volume + 1])
+        return LabelIndex(self.label_values[labels], self.voxels[voxels], self.voxel_labels[voxels],
+                          self.labels.shape[1:], numpy.array(self.affine))
+
+
+def load_bundle(identity: str, bundle_dir=None):
+    """
+    :param identity: atlas identity (see utils.atlas.atlas_identity)
+    :param bundle_dir: where bundles are compiled (default_bundle_dir() if None)
+    :return: the AtlasBundle or None if it was not compiled
+    """
+    path = Path(bundle_dir or default_bundle_dir()) / identity
+    key = str(path)
+    if key not in _BUNDLES:
+        if not (path / 'meta.json').exists():
+            return None
+        _BUNDLES[key] = AtlasBundle(path)
+    return _BUNDLES[key]
+
+
+def compile_bundle(atlas_img: nibabel.Nifti1Image, identity: str, bundle_dir=None, background_label: int = 0) -> str:
+    """
+    :param atlas_img: 3D label image or 4D image with one parcellation per volume
+    :param identity: atlas identity (see utils.atlas.atlas_identity)
+    :param bundle_dir: where bundles are compiled (default_bundle_dir() if None)
+    :return: path of the bundle
+    """
+    label_data = numpy.asanyarray(atlas_img.dataobj)
+    if label_data.ndim == 3:
+        label_data = label_data[..., numpy.newaxis]
+    if label_data.min() < 0 or label_data.max() > numpy.iinfo(numpy.uint16).max:
+        raise RuntimeError("Labels of %s do not fit in uint16" % identity)
+    volumes = numpy.ascontiguousarray(numpy.moveaxis(label_data, -1, 0), dtype=numpy.uint16)
+    affine = numpy.asarray(atlas_img.affine, dtype=numpy.float64)
+
+    arrays = {name: [] for name in ['label_values', 'counts', 'centroids', 'voxels', 'voxel_labels']}
+    label_counts, voxel_counts = [], []
+    for volume in volumes:
+        index = LabelIndex.from_array(volume, affine, background_label=background_label)
+        world = numpy.asarray(index.coords).T @ affine[:3, :3].T + affine[:3, 3]
+        centroids = numpy.stack([numpy.bincount(index.label_ids, weights=world[:, axis], minlength=index.n_labels)
+                                 for axis in range(3)], axis=1) / index.counts[:, numpy.newaxis]
+        arrays['label_values'].append(index.labels.astype(numpy.uint16))
+        arrays['counts'].append(index.counts.astype(numpy.int32))
+        arrays['centroids'].append(centroids)
+        arrays['voxels'].append(index.voxels.astype(numpy.int32))
+        arrays['voxel_labels'].append(index.label_ids.astype(numpy.int32))
+        label_counts.append(index.n_labels)
+        voxel_counts.append(len(index.voxels))
+    arrays = {name: numpy.concatenate(values) for name, values in arrays.items()}
+    arrays['labels'] = volumes
+    arrays['affine'] = affine
+    arrays['label_offsets'] = numpy.concatenate([[0], numpy.cumsum(label_counts)]).astype(numpy.int64)
+    arrays['voxel_offsets'] = numpy.concatenate([[0], numpy.cumsum(voxel_counts)]).astype(numpy.int64)
+
+    bundle_dir = Path(bundle_dir or default_bundle_dir())
+    bundle_dir.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(prefix=identity + '.', dir=str(bundle_dir)))
+    for name in _ARRAYS:
+        numpy.save(str(tmp / (name + '.npy')), arrays[name], allow_pickle=False)
+    with (tmp / 'meta.json').open('w') as fobj:
+        json.dump(dict(identity=identity, format_version=BUNDLE_FORMAT_VERSION, shape=list(volumes.shape)), fobj,
+                  indent=2)
+    path = bundle_dir / identity
+    if path.exists():
+        shutil.rmtree(str(path))
+    os.replace(str(tmp), str(path))
+    _BUNDLES.pop(str(path), None)
+    return str(path)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Caches kept in the working directory
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+"""
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+
+import nibabel
+import numpy
+from nipype import logging
+
+from .constants import DEFAULT_BOLD_CACHE_GB
+from .extraction import resample_labels, same_grid
+
+LOGGER = logging.getLogger('nipype.interface')
+
+NIFTI_HEADER_BYTES = 540  # large enough for nifti1 (348) and nifti2 (540) headers
+_COPY_BUFFER = 16 * 1024 * 1024
+
+
+class BoldCache(object):
+    """
+    Uncompressed copies of .nii.gz inputs, so every extraction after the first one
+    memory-maps the data instead of inflating it again.
+
+    Entries are keyed by path, size, mtime and a hash of the header, and the least
+    recently used entries are removed once the cache grows past max_size_gb.
+    """
+
+    def __init__(self, cache_dir, max_size_gb: float = DEFAULT_BOLD_CACHE_GB):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(nifti) -> str:
+        nifti = Path(nifti).resolve()
+        stat = nifti.stat()
+        with gzip.open(str(nifti), 'rb') as fobj:
+            header = fobj.read(NIFTI_HEADER_BYTES)
+        key = hashlib.sha1()
+        key.update(('%s|%d|%d|' % (nifti, stat.st_size, stat.st_mtime_ns)).encode())
+        key.update(header)
+        return key.hexdigest()
+
+    def get(self, nifti) -> str:
+        """
+        :param nifti: path to a nifti file
+        :return: path to an uncompressed copy of nifti (nifti itself if it is not compressed)
+        """
+        if not str(nifti).endswith('.gz'):
+            return str(nifti)
+        cached = self.cache_dir / (self.key(nifti) + '.nii')
+        if cached.exists():
+            LOGGER.debug('Using cached uncompressed copy %s of %s', cached, nifti)
+            os.utime(str(cached))  # mark as recently used
+            return str(cached)
+
+        LOGGER.debug('Caching an uncompressed copy of %s in %s', nifti, self.cache_dir)
+        fd, tmp = tempfile.mkstemp(suffix='.nii.part', dir=str(self.cache_dir))
+        try:
+            with gzip.open(str(nifti), 'rb') as src, os.fdopen(fd, 'wb') as dst:
+                shutil.copyfileobj(src, dst, _COPY_BUFFER)
+            os.replace(tmp, str(cached))  # atomic, so concurrent workers never see a partial file
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.evict(keep=cached)
+        return str(cached)
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits in max_size"""
+        entries = []
+        for entry in self.cache_dir.glob('*.nii'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:  # removed by another worker
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_size:
+                break
+            if keep is not None and entry == keep:
+                continue
+            LOGGER.debug('Evicting %s from the uncompressed image cache', entry)
+            try:
+                entry.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class ResampledAtlasCache(object):
+    """
+    Atlases resampled to the grid of the source images, kept in memory for the process and
+    (when cache_dir is given) as .npy label arrays on disk, keyed by atlas identity plus target
+    shape and affine. Runs of a dataset usually share one grid, so each grid is resampled once.
+
+    The arrays on disk (and those of shared_arrays, e.g. voxel indices) are memory-mapped, so
+    once the workflow has prepared them every worker attaches to the same pages instead of
+    loading and resampling its own copy.
+    """
+    MAX_MEMORY_ENTRIES = 16
+
+    _memory = OrderedDict()
+    memory_hits = 0
+    disk_hits = 0
+    misses = 0
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(identity: str, target_img) -> str:
+        key = hashlib.sha1()
+        key.update(('%s|%s|' % (identity, str(tuple(target_img.shape[:3])))).encode())
+        key.update(numpy.round(numpy.asarray(target_img.affine, dtype=numpy.float64), 6).tobytes())
+        return key.hexdigest()
+
+    def resample(self, atlas_img: nibabel.Nifti1Image, target_img, identity: str) -> nibabel.Nifti1Image:
+        """
+        :param atlas_img: 3D or 4D label image
+        :param target_img: image whose grid the atlas is needed on
+        :param identity: unique name of atlas_img (e.g. shen_1mm)
+        :return: atlas_img on the grid of target_img
+        """
+        if same_grid(atlas_img, target_img):
+            return atlas_img
+        cls = type(self)
+        key = self.key(identity, target_img)
+        if key in cls._memory:
+            cls._memory.move_to_end(key)
+            cls.memory_hits += 1
+            label_data = cls._memory[key]
+        else:
+            cached = self.cache_dir / (key + '.npy') if self.cache_dir is not None else None
+            if cached is not None and cached.exists():
+                cls.disk_hits += 1
+                # memory-mapped, so every worker shares the pages of one copy
+                label_data = numpy.load(str(cached), mmap_mode='r')
+            else:
+                cls.misses += 1
+                label_data = numpy.asanyarray(resample_labels(atlas_img, target_img).dataobj)
+                if cached is not None:
+                    fd, tmp = tempfile.mkstemp(suffix='.npy.part', dir=str(self.cache_dir))
+                    with os.fdopen(fd, 'wb') as fobj:
+                        numpy.save(fobj, label_data)
+                    os.replace(tmp, str(cached))
+            cls._memory[key] = label_data
+            if len(cls._memory) > self.MAX_MEMORY_ENTRIES:
+                cls._memory.popitem(last=False)
+        LOGGER.info('Resampled atlas cache (%s): %d memory hits, %d disk hits, %d misses',
+                    identity, cls.memory_hits, cls.disk_hits, cls.misses)
+        return nibabel.Nifti1Image(label_data, target_img.affine)
+
+    def shared_arrays(self, identity: str, target_img, kind: str, build) -> dict:
+        """
+        Arrays derived from an atlas on the grid of target_img, computed once and memory-mapped
+        from cache_dir after that (only computed when there is no cache_dir).
+        :param identity: unique name of the atlas (e.g. shen_1mm)
+        :param target_img: image whose grid the arrays belong to
+        :param kind: name of what build computes (e.g. label_index)
+        :param build: function returning a dict of arrays
+        :return: dict of (memory-mapped) arrays
+        """
+        if self.cache_dir is None:
+            return build()
+        path = self.cache_dir / ('%s.%s' % (self.key(identity, target_img), kind))
+        if not path.exists():
+            tmp = Path(tempfile.mkdtemp(suffix='.part', dir=str(self.cache_dir)))
+            for name, array in build().items():
+                numpy.save(str(tmp / (name + '.npy')), numpy.asarray(array), allow_pickle=False)
+            try:
+                os.replace(str(tmp), str(path))
+            except OSError:  # published by another worker in the meantime
+                shutil.rmtree(str(tmp), ignore_errors=True)
+        return {array.stem: numpy.load(str(array), mmap_mode='r', allow_pickle=False)
+                for array in path.glob('*.npy')}
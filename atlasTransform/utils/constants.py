@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Choices and defaults of the command line options
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+
+Kept free of any import so that building and validating the argument parser (``--help``,
+``--version``, a typo in an option) does not load nipype, nibabel or numpy. The modules
+implementing the options import their values from here.
+"""
+
+CRADDOCK_CLUSTER_SIZES = [
+    10,20,30,40,50,60,70,80,90,100,110,120,130,140,150,160,170,180,190,200,210,220,230,240,250,260,270,280,290,300,
+    350,400,450,500,550,600,650,700,750,800,850,900,950
+]
+DEFAULT_BOLD_CACHE_GB = 50.
+EXTRACTION_ENGINES = ['nilearn', 'native']
+SPHERE_OVERLAP_POLICIES = ['error', 'allow', 'nearest']
+GROUP_STORE_MODES = ['alongside', 'only']
+OUTPUT_EXTENSIONS = {
+    'csv': '.csv',
+    'npy': '.npy',
+    'npz': '.npz',
+    'hdf5': '.h5',
+    'parquet': '.parquet',
+}
+OUTPUT_FORMATS = list(OUTPUT_EXTENSIONS)
+OUTPUT_PRECISIONS = ['float64', 'float32']
+PROFILE_MODES = ['sidecar', 'summary']
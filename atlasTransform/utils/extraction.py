@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Native ROI extraction engine
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+"""
+from collections import OrderedDict
+
+import numpy
+import nibabel
+from scipy import sparse
+from scipy.ndimage import gaussian_filter1d
+from scipy.spatial import cKDTree
+from nipype import logging
+
+from .constants import SPHERE_OVERLAP_POLICIES
+
+LOGGER = logging.getLogger('nipype.interface')
+
+
+def same_grid(img, target_img) -> bool:
+    return (tuple(img.shape[:3]) == tuple(target_img.shape[:3]) and
+            numpy.allclose(img.affine, target_img.affine))
+
+
+def resample_labels(atlas_img: nibabel.Nifti1Image, target_img: nibabel.Nifti1Image) -> nibabel.Nifti1Image:
+    """
+    Put a label image on the grid of target_img the same way NiftiLabelsMasker does
+    (nearest neighbour, only when the grids differ).
+    """
+    if same_grid(atlas_img, target_img):
+        return atlas_img
+    from nilearn.image import resample_img
+    return resample_img(atlas_img, target_affine=target_img.affine, target_shape=target_img.shape[:3],
+                        interpolation='nearest')
+
+
+class LabelIndex(object):
+    """
+    A label image compiled into a flat voxel-index / label-id representation.
+
+    voxels holds the (Fortran order) flat index of every non-background voxel on the
+    grid, label_ids holds the column of labels each of those voxels belongs to.
+    All ROI means for all timepoints are then one sparse product.
+    """
+
+    def __init__(self, labels, voxels, label_ids, shape, affine):
+        self.labels = numpy.asarray(labels)
+        self.voxels = numpy.asarray(voxels, dtype=numpy.int64)
+        self.label_ids = numpy.asarray(label_ids, dtype=numpy.int64)
+        self.shape = tuple(int(s) for s in shape[:3])
+        self.affine = numpy.asarray(affine)
+        self.counts = numpy.bincount(self.label_ids, minlength=len(self.labels))
+        self._coords = None
+        self._matrix = None
+
+    @classmethod
+    def from_img(cls, atlas_img: nibabel.Nifti1Image, target_img: nibabel.Nifti1Image = None,
+                 background_label: int = 0):
+        """
+        :param atlas_img: 3D label image
+        :param target_img: image whose grid the index is built for (atlas grid if None)
+        :param background_label: label value that is not a region
+        :return:
+        """
+        if target_img is not None:
+            atlas_img = resample_labels(atlas_img, target_img)
+        return cls.from_array(numpy.asanyarray(atlas_img.dataobj), atlas_img.affine,
+                              background_label=background_label)
+
+    @classmethod
+    def from_array(cls, label_data: numpy.ndarray, affine: numpy.ndarray, background_label: int = 0):
+        label_data = numpy.asarray(label_data)
+        if label_data.ndim != 3:
+            raise RuntimeError("A label index needs a 3D label image, got shape %s" % str(label_data.shape))
+        flat = label_data.ravel(order='F')
+        voxels = numpy.flatnonzero(flat != background_label)
+        labels, label_ids = numpy.unique(flat[voxels], return_inverse=True)
+        return cls(labels, voxels, label_ids, label_data.shape, affine)
+
+    @property
+    def n_labels(self) -> int:
+        return len(self.labels)
+
+    @property
+    def coords(self) -> tuple:
+        if self._coords is None:
+            self._coords = numpy.unravel_index(self.voxels, self.shape, order='F')
+        return self._coords
+
+    @property
+    def matrix(self) -> sparse.csr_matrix:
+        """(labels x voxels) indicator matrix"""
+        if self._matrix is None:
+            self._matrix = sparse.csr_matrix(
+                (numpy.ones(len(self.voxels)), (self.label_ids, numpy.arange(len(self.voxels)))),
+                shape=(self.n_labels, len(self.voxels)))
+        return self._matrix
+
+    def gather(self, data: numpy.ndarray) -> numpy.ndarray:
+        """
+        Pull the labelled voxels out of a 3D or 4D array on this grid.
+        :return: (voxels x timepoints) float64 array, non-finite values set to 0 like nilearn
+        """
+        return _gather(data, self.coords, self.shape)
+
+    def sums(self, values: numpy.ndarray) -> numpy.ndarray:
+        """(labels x timepoints) sums of gathered voxel values"""
+        return numpy.asarray(self.matrix @ values)
+
+    def transform(self, data: numpy.ndarray) -> numpy.ndarray:
+        """
+        Average every ROI for every timepoint.
+        :param data: 3D or 4D array on the index grid
+        :return: (timepoints x labels) array, like NiftiLabelsMasker.fit_transform
+        """
+        return (self.sums(self.gather(data)) / self.counts[:, numpy.newaxis]).T
+
+    def transform_with_errors(self, data: numpy.ndarray, errors: numpy.ndarray) -> tuple:
+        """
+        ROI means together with the propagated ROI uncertainty, in one sparse product.
+        If X = sum(x_i)/n, i = 1,...,n
+        then dX = sqrt(sum(dx_i**2))/n, i=1,...,n
+        :param data: 3D or 4D array on the index grid
+        :param errors: uncertainty of every voxel of data (same shape)
+        :return: (timepoints x labels) means and (timepoints x labels) errors
+        """
+        values = self.gather(data)
+        sums = self.sums(numpy.hstack((values, numpy.square(self.gather(errors)))))
+        return _means_and_errors(sums, values.shape[1], self.counts)
+
+    def extract(self, data: numpy.ndarray, errors: numpy.ndarray = None) -> list:
+        """:return: [(means, propagated errors or None)]"""
+        if errors is not None:
+            return [self.transform_with_errors(data, errors)]
+        return [(self.transform(data), None)]
+
+
+class PartitionIndex(object):
+    """
+    Several parcellations of the same grid compiled over their intersection partition.
+
+    Every voxel is assigned to the cell of the finest common refinement of all
+    parcellations it belongs to, so the voxel sums are computed once per cell and each
+    parcellation's ROI means are a sparse aggregation of the cell sums.
+    """
+
+    def __init__(self, partition: LabelIndex, cell_labels: numpy.ndarray, background_label: int = 0):
+        """
+        :param partition: label index whose labels are the partition cells
+        :param cell_labels: (cells x parcellations) label of every cell in every parcellation
+        """
+        self.partition = partition
+        self.cell_labels = cell_labels
+        self.levels = []
+        for level in range(cell_labels.shape[1]):
+            cells = numpy.flatnonzero(cell_labels[:, level] != background_label)
+            labels, label_ids = numpy.unique(cell_labels[cells, level], return_inverse=True)
+            aggregation = sparse.csr_matrix(
+                (numpy.ones(len(cells)), (label_ids, cells)),
+                shape=(len(labels), partition.n_labels))
+            counts = aggregation @ partition.counts
+            self.levels.append((labels, aggregation, counts))
+
+    @classmethod
+    def from_img(cls, atlas_img: nibabel.Nifti1Image, target_img: nibabel.Nifti1Image = None,
+                 background_label: int = 0):
+        """
+        :param atlas_img: 4D image with one parcellation per volume
+        :param target_img: image whose grid the index is built for (atlas grid if None)
+        :param background_label: label value that is not a region
+        :return:
+        """
+        if target_img is not None:
+            atlas_img = resample_labels(atlas_img, target_img)
+        return cls.from_array(numpy.asanyarray(atlas_img.dataobj), atlas_img.affine,
+                              background_label=background_label)
+
+    @classmethod
+    def from_array(cls, label_data: numpy.ndarray, affine: numpy.ndarray, background_label: int = 0):
+        label_data = numpy.asarray(label_data)
+        if label_data.ndim != 4:
+            raise RuntimeError("A partition index needs a 4D label image, got shape %s" % str(label_data.shape))
+        flat = label_data.reshape((-1, label_data.shape[3]), order='F')
+        voxels = numpy.flatnonzero((flat != background_label).any(axis=1))
+        cell_labels, cell_ids = numpy.unique(flat[voxels], axis=0, return_inverse=True)
+        partition = LabelIndex(numpy.arange(len(cell_labels)), voxels, cell_ids.ravel(), label_data.shape, affine)
+        return cls(partition, cell_labels, background_label=background_label)
+
+    def transform(self, data: numpy.ndarray) -> list:
+        """
+        Average every ROI of every parcellation for every timepoint.
+        :param data: 3D or 4D array on the index grid
+        :return: one (timepoints x labels) array per parcellation
+        """
+        cell_sums = self.partition.sums(self.partition.gather(data))
+        return [(numpy.asarray(aggregation @ cell_sums) / counts[:, numpy.newaxis]).T
+                for _, aggregation, counts in self.levels]
+
+    def transform_with_errors(self, data: numpy.ndarray, errors: numpy.ndarray) -> list:
+        """
+        Like LabelIndex.transform_with_errors for every parcellation.
+        :return: one ((timepoints x labels) means, (timepoints x labels) errors) pair per parcellation
+        """
+        values = self.partition.gather(data)
+        cell_sums = self.partition.sums(numpy.hstack((values, numpy.square(self.partition.gather(errors)))))
+        return [_means_and_errors(numpy.asarray(aggregation @ cell_sums), values.shape[1], counts)
+                for _, aggregation, counts in self.levels]
+
+    def extract(self, data: numpy.ndarray, errors: numpy.ndarray = None) -> list:
+        """:return: one (means, propagated errors or None) pair per parcellation"""
+        if errors is not None:
+            return self.transform_with_errors(data, errors)
+        return [(roi_data, None) for roi_data in self.transform(data)]
+
+
+class SphereIndex(object):
+    """
+    Voxel membership of spheres around seed coordinates, compiled into a sparse
+    (spheres x voxels) averaging matrix so extraction is one gather and one product.
+
+    Membership follows NiftiSpheresMasker: every voxel whose centre lies within radius mm
+    of the seed, plus the voxel nearest to the seed (so radius=None gives single voxels).
+    Voxels inside several spheres are handled by the overlap policy:
+    'error' raises (nilearn's default), 'allow' counts the voxel in every sphere and
+    'nearest' keeps it only in the sphere with the closest seed.
+    """
+
+    def __init__(self, matrix: sparse.csr_matrix, voxels, shape, affine):
+        self.matrix = matrix
+        self.voxels = numpy.asarray(voxels, dtype=numpy.int64)
+        self.shape = tuple(int(s) for s in shape[:3])
+        self.affine = numpy.asarray(affine)
+        self.coords = numpy.unravel_index(self.voxels, self.shape, order='F')
+
+    @classmethod
+    def from_seeds(cls, seeds, shape, affine, radius: float = None, overlap: str = 'error'):
+        """
+        :param seeds: (spheres x 3) world coordinates
+        :param shape: grid shape
+        :param affine: grid affine
+        :param radius: sphere radius in mm, None for the single nearest voxel
+        :param overlap: one of SPHERE_OVERLAP_POLICIES
+        :return:
+        """
+        if overlap not in SPHERE_OVERLAP_POLICIES:
+            raise RuntimeError("%s is not a valid sphere overlap policy. Please use one of %s" % (
+                overlap, str(SPHERE_OVERLAP_POLICIES)))
+        seeds = numpy.asarray(seeds, dtype=numpy.float64)
+        shape = tuple(int(s) for s in shape[:3])
+        affine = numpy.asarray(affine, dtype=numpy.float64)
+        inverse = numpy.linalg.inv(affine)
+        seed_voxels = seeds @ inverse[:3, :3].T + inverse[:3, 3]
+
+        # candidate voxels: the bounding boxes of all spheres
+        reach = numpy.zeros(3)
+        if radius:
+            reach = numpy.ceil(radius * numpy.sqrt(numpy.sum(inverse[:3, :3] ** 2, axis=1)))
+        candidates = set()
+        for seed_voxel in seed_voxels:
+            low = numpy.maximum(numpy.floor(seed_voxel - reach), 0).astype(int)
+            high = numpy.minimum(numpy.ceil(seed_voxel + reach), numpy.array(shape) - 1).astype(int)
+            if numpy.any(low > high):
+                continue
+            box = numpy.mgrid[low[0]:high[0] + 1, low[1]:high[1] + 1, low[2]:high[2] + 1].reshape(3, -1)
+            candidates.update(numpy.ravel_multi_index(box, shape, order='F').tolist())
+        candidates = numpy.array(sorted(candidates), dtype=numpy.int64)
+        candidate_world = numpy.asarray(numpy.unravel_index(candidates, shape, order='F')).T @ affine[:3, :3].T \
+            + affine[:3, 3]
+
+        rows, columns = [], []
+        if radius and len(candidates):
+            for sphere, members in enumerate(cKDTree(candidate_world).query_ball_point(seeds, radius)):
+                rows.extend([sphere] * len(members))
+                columns.extend(members)
+        nearest = numpy.round(seed_voxels).astype(int)
+        for sphere, voxel in enumerate(nearest):
+            if numpy.all(voxel >= 0) and numpy.all(voxel < shape):
+                rows.append(sphere)
+                columns.append(numpy.searchsorted(candidates, numpy.ravel_multi_index(voxel, shape, order='F')))
+        membership = sparse.coo_matrix((numpy.ones(len(rows)), (rows, columns)),
+                                       shape=(len(seeds), len(candidates))).tocsr()
+        membership.data[:] = 1  # voxels listed twice (within radius and nearest) count once
+
+        empty = numpy.flatnonzero(numpy.diff(membership.indptr) == 0)
+        if len(empty):
+            raise RuntimeError("These spheres are empty: %s" % str(empty))
+        shared = numpy.asarray(membership.sum(axis=0)).ravel() >= 2
+        if shared.any():
+            if overlap == 'error':
+                raise RuntimeError("Overlap detected between spheres")
+            if overlap == 'nearest':
+                membership = membership.tolil()
+                for column in numpy.flatnonzero(shared):
+                    spheres = membership[:, column].nonzero()[0]
+                    distances = numpy.linalg.norm(seeds[spheres] - candidate_world[column], axis=1)
+                    for sphere in spheres[spheres != spheres[numpy.argmin(distances)]]:
+                        membership[sphere, column] = 0
+                membership = membership.tocsr()
+                membership.eliminate_zeros()
+                empty = numpy.flatnonzero(numpy.diff(membership.indptr) == 0)
+                if len(empty):
+                    raise RuntimeError("These spheres are empty after resolving overlap: %s" % str(empty))
+
+        used = numpy.flatnonzero(numpy.asarray(membership.sum(axis=0)).ravel())
+        membership = membership[:, used]
+        sizes = numpy.asarray(membership.sum(axis=1)).ravel()
+        matrix = sparse.diags(1. / sizes) @ membership
+        return cls(matrix.tocsr(), candidates[used], shape, affine)
+
+    def smoothed(self, fwhm: float):
+        """
+        Fold a Gaussian smoothing of the image (as nilearn.image.smooth_img does it) into the
+        sphere weights: the average of a sphere in the smoothed image is a fixed weighted sum
+        over a slightly larger neighbourhood of the raw image.
+        :param fwhm: full width at half maximum in mm
+        :return: a SphereIndex applied to the raw image
+        """
+        vox_size = numpy.sqrt(numpy.sum(self.affine[:3, :3] ** 2, axis=0))
+        sigma = fwhm / (numpy.sqrt(8 * numpy.log(2)) * vox_size)
+        # smoothing operator along each axis, operators[n][i, u] = weight of u in smoothed voxel i
+        operators = []
+        for n, s in enumerate(sigma):
+            operator = numpy.eye(self.shape[n])
+            if s > 0.:
+                operator = gaussian_filter1d(operator, s, axis=0)
+            operators.append(operator)
+
+        coords = numpy.asarray(self.coords)
+        matrix = self.matrix.tocsr()
+        rows, columns, weights = [], [], []
+        for sphere in range(self.n_spheres):
+            start, stop = matrix.indptr[sphere], matrix.indptr[sphere + 1]
+            sphere_coords = coords[:, matrix.indices[start:stop]]
+            low, high = sphere_coords.min(axis=1), sphere_coords.max(axis=1) + 1
+            # the sphere weights on their bounding box, smoothed one axis at a time (the operator is
+            # separable); each tensordot contracts the leading axis and appends the smoothed one
+            sphere_weights = numpy.zeros(high - low)
+            sphere_weights[tuple(sphere_coords - low[:, numpy.newaxis])] = matrix.data[start:stop]
+            support = []
+            for n in range(3):
+                operator = operators[n][low[n]:high[n]]
+                support.append(numpy.flatnonzero(operator.any(axis=0)))
+                sphere_weights = numpy.tensordot(sphere_weights, operator[:, support[n]], axes=([0], [0]))
+            nonzero = numpy.nonzero(sphere_weights)
+            voxels = numpy.ravel_multi_index(tuple(support[n][nonzero[n]] for n in range(3)), self.shape, order='F')
+            rows.append(numpy.full(len(voxels), sphere))
+            columns.append(voxels)
+            weights.append(sphere_weights[nonzero])
+        voxels, columns = numpy.unique(numpy.concatenate(columns), return_inverse=True)
+        smoothed = sparse.csr_matrix((numpy.concatenate(weights), (numpy.concatenate(rows), columns.ravel())),
+                                     shape=(self.n_spheres, len(voxels)))
+        return type(self)(smoothed, voxels, self.shape, self.affine)
+
+    @property
+    def n_spheres(self) -> int:
+        return self.matrix.shape[0]
+
+    def gather(self, data: numpy.ndarray) -> numpy.ndarray:
+        """(voxels x timepoints) float64 array of the voxels used by any sphere"""
+        return _gather(data, self.coords, self.shape)
+
+    def transform(self, data: numpy.ndarray) -> numpy.ndarray:
+        """
+        Average every sphere for every timepoint.
+        :param data: 3D or 4D array on the index grid
+        :return: (timepoints x spheres) array
+        """
+        return numpy.asarray(self.matrix @ self.gather(data)).T
+
+
+_SPHERE_INDICES = OrderedDict()
+_MAX_SPHERE_INDICES = 8
+
+
+def get_sphere_index(seeds, shape, affine, radius: float = None, overlap: str = 'error',
+                     smoothing_fwhm: float = None) -> SphereIndex:
+    """
+    SphereIndex.from_seeds (smoothed with smoothing_fwhm if given), computed once per
+    (seeds, grid, radius, overlap, fwhm) in this process
+    """
+    key = (numpy.asarray(seeds, dtype=numpy.float64).tobytes(), tuple(int(s) for s in shape[:3]),
+           numpy.round(numpy.asarray(affine, dtype=numpy.float64), 6).tobytes(), radius, overlap, smoothing_fwhm)
+    if key in _SPHERE_INDICES:
+        _SPHERE_INDICES.move_to_end(key)
+        return _SPHERE_INDICES[key]
+    sphere_index = SphereIndex.from_seeds(seeds, shape, affine, radius=radius, overlap=overlap)
+    if smoothing_fwhm:
+        sphere_index = sphere_index.smoothed(smoothing_fwhm)
+    _SPHERE_INDICES[key] = sphere_index
+    if len(_SPHERE_INDICES) > _MAX_SPHERE_INDICES:
+        _SPHERE_INDICES.popitem(last=False)
+    return sphere_index
+
+
+def _gather(data: numpy.ndarray, coords: tuple, shape: tuple) -> numpy.ndarray:
+    """
+    Pull the voxels at coords out of a 3D or 4D array on a grid of the given shape.
+    :return: (voxels x timepoints) float64 array, non-finite values set to 0 like nilearn
+    """
+    if tuple(data.shape[:3]) != shape:
+        raise RuntimeError("Image shape %s does not match the index grid %s" % (str(data.shape[:3]), str(shape)))
+    if data.ndim == 3:
+        data = data[..., numpy.newaxis]
+    values = numpy.asarray(data[coords], dtype=numpy.float64)
+    values[~numpy.isfinite(values)] = 0
+    return values
+
+
+def iter_volume_blocks(img: nibabel.Nifti1Image, block_size: int):
+    """
+    Read a 4D image in consecutive blocks of volumes through its array proxy, so at most
+    block_size volumes are decoded in memory at a time.
+    """
+    for start in range(0, img.shape[3], block_size):
+        yield numpy.asanyarray(img.dataobj[..., start:start + block_size])
+
+
+def _means_and_errors(sums, n_timepoints, counts) -> tuple:
+    """Split stacked (labels x [sums, sums of squared errors]) into means and propagated errors"""
+    counts = counts[:, numpy.newaxis]
+    means = sums[:, :n_timepoints] / counts
+    errors = numpy.sqrt(sums[:, n_timepoints:]) / counts
+    return means.T, errors.T
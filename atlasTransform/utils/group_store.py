@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Consolidated HDF5 store of the roi data of a whole group
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+
+Every extraction appends one small shard under ``<store>/shards``; shards have unique
+names, so concurrent workers never write to the same file. ``merge_group_store`` then
+moves all shards into ``<store>/group.h5`` (one writer, under a lock) laid out as
+``/sub-<label>[/ses-<label>]/<source file stem>/<atlas>/{roi_data,confidence_intervals}``
+and rewrites ``<store>/index.tsv`` with one row per subject/session/task/run/atlas.
+"""
+import os
+import re
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy
+from nipype import logging
+
+LOGGER = logging.getLogger('nipype.interface')
+
+GROUP_STORE_FILE = 'group.h5'
+GROUP_INDEX_FILE = 'index.tsv'
+SHARD_DIR = 'shards'
+ENTITIES = ['subject', 'session', 'task', 'run']
+_ENTITY_PATTERNS = {
+    'subject': re.compile(r'(?:^|_)sub-([a-zA-Z0-9]+)'),
+    'session': re.compile(r'(?:^|_)ses-([a-zA-Z0-9]+)'),
+    'task': re.compile(r'(?:^|_)task-([a-zA-Z0-9]+)'),
+    'run': re.compile(r'(?:^|_)run-([a-zA-Z0-9]+)'),
+}
+
+
+def _h5py():
+    try:
+        import h5py
+    except ImportError:
+        raise RuntimeError("The group store requires h5py (pip install h5py)")
+    return h5py
+
+
+def group_store_dir(output_dir) -> str:
+    """the group store of an output directory"""
+    return str(Path(output_dir).resolve() / 'atlasTransform' / 'group_store')
+
+
+def source_entities(source_file: str) -> dict:
+    """subject, session, task and run labels of a BIDS file name ('' when absent)"""
+    name = Path(source_file).name
+    entities = {}
+    for entity, pattern in _ENTITY_PATTERNS.items():
+        match = pattern.search(name)
+        entities[entity] = match.group(1) if match else ''
+    return entities
+
+
+def write_shard(store_dir, source_file: str, results: list, precision: str = 'float64') -> str:
+    """
+    :param store_dir: group store directory
+    :param source_file: the image the roi data were extracted from
+    :param results: (atlas name, roi data, propagated errors or None) for every atlas
+    :param precision: float64 or float32
+    :return: path of the shard
+    """
+    h5py = _h5py()
+    shard_dir = Path(store_dir) / SHARD_DIR
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    shard = shard_dir / ('%s.h5' % uuid.uuid4().hex)
+    tmp = shard.with_suffix('.part')
+    with h5py.File(str(tmp), 'w') as fobj:
+        fobj.attrs['source'] = str(source_file)
+        for entity, label in source_entities(source_file).items():
+            fobj.attrs[entity] = label
+        for out_name, roi_data, ci_data in results:
+            group = fobj.create_group(out_name)
+            for dataset, data in [('roi_data', roi_data), ('confidence_intervals', ci_data)]:
+                if data is None:
+                    continue
+                data = numpy.asarray(data, dtype=precision)
+                group.create_dataset(dataset, data=data, chunks=True if data.ndim > 1 else None)
+    os.replace(str(tmp), str(shard))
+    return str(shard)
+
+
+@contextmanager
+def _locked(store_dir):
+    import fcntl
+    with open(str(Path(store_dir) / '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _run_path(attrs) -> str:
+    path = 'sub-%s' % attrs['subject']
+    if attrs['session']:
+        path += '/ses-%s' % attrs['session']
+    return path + '/' + Path(attrs['source']).name.split('.')[0]
+
+
+def merge_group_store(store_dir) -> int:
+    """
+    Move every shard of store_dir into the consolidated store and rewrite its index.
+    Reruns replace the entries of the same source file and atlas.
+    :return: number of merged shards
+    """
+    h5py = _h5py()
+    store_dir = Path(store_dir)
+    shards = sorted((store_dir / SHARD_DIR).glob('*.h5'), key=lambda shard: shard.stat().st_mtime)
+    if not shards:
+        return 0
+    with _locked(store_dir), h5py.File(str(store_dir / GROUP_STORE_FILE), 'a') as store:
+        for shard in shards:
+            with h5py.File(str(shard), 'r') as fobj:
+                run_path = _run_path(fobj.attrs)
+                run_group = store.require_group(run_path)
+                for key in ['source'] + ENTITIES:
+                    run_group.attrs[key] = fobj.attrs[key]
+                for out_name in fobj:
+                    if out_name in run_group:
+                        del run_group[out_name]
+                    fobj.copy(fobj[out_name], run_group, name=out_name)
+            shard.unlink()
+        _write_index(store, store_dir / GROUP_INDEX_FILE)
+    LOGGER.info('Merged %d shards into %s', len(shards), store_dir / GROUP_STORE_FILE)
+    return len(shards)
+
+
+def _write_index(store, index_file):
+    rows = []
+
+    def visit(name, obj):
+        if 'roi_data' in getattr(obj, 'keys', lambda: [])():
+            run_group = obj.parent
+            rows.append([run_group.attrs[key] for key in ENTITIES] +
+                        [name.rsplit('/', 1)[-1], run_group.attrs['source'], name])
+
+    store.visititems(visit)
+    with open(str(index_file), 'w') as fobj:
+        fobj.write('\t'.join(ENTITIES + ['atlas', 'source', 'path']) + '\n')
+        for row in sorted(rows):
+            fobj.write('\t'.join(str(value) for value in row) + '\n')
+
+
+def read_group_store(store_dir, path: str, dataset: str = 'roi_data') -> numpy.ndarray:
+    """
+    :param store_dir: group store directory
+    :param path: the path column of index.tsv
+    :param dataset: roi_data or confidence_intervals
+    """
+    h5py = _h5py()
+    with h5py.File(str(Path(store_dir) / GROUP_STORE_FILE), 'r') as store:
+        return store[path][dataset][()]
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Manifest of finished extractions for incremental reruns
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+
+One small JSON entry per source image and atlas under ``<output_dir>/atlasTransform/manifest``,
+holding the extraction key and the files it produced. The key combines a fingerprint of the
+input (size, mtime, header bytes and optionally a hash of a few sampled blocks) with every
+option that changes the roi data and the package version, so an entry whose key still matches
+means the outputs can be reused and the run is left out of the workflow.
+"""
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+from .cache import NIFTI_HEADER_BYTES
+
+SAMPLE_BLOCK_BYTES = 64 * 1024
+
+
+def manifest_dir(output_dir) -> str:
+    """the manifest of an output directory"""
+    return str(Path(output_dir).resolve() / 'atlasTransform' / 'manifest')
+
+
+def file_fingerprint(path, sample_blocks: int = 0) -> dict:
+    """
+    Cheap fingerprint of a nifti file, nothing but the header and (optionally) sample_blocks evenly
+    spaced blocks of the file are read.
+    """
+    path = Path(path).resolve()
+    stat = path.stat()
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(str(path), 'rb') as fobj:
+        header = fobj.read(NIFTI_HEADER_BYTES)
+    fingerprint = {
+        'path': str(path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'header': hashlib.sha1(header).hexdigest(),
+    }
+    if sample_blocks > 0:
+        sampled = hashlib.sha1()
+        step = max(stat.st_size // sample_blocks, 1)
+        with open(str(path), 'rb') as fobj:
+            for offset in range(0, stat.st_size, step)[:sample_blocks]:
+                fobj.seek(offset)
+                sampled.update(fobj.read(SAMPLE_BLOCK_BYTES))
+        fingerprint['sampled'] = sampled.hexdigest()
+    return fingerprint
+
+
+def extraction_key(fingerprints: list, params: dict) -> str:
+    """
+    :param fingerprints: file_fingerprint of every input of the extraction
+    :param params: every option the roi data depend on (atlas, resolution, ..., version)
+    """
+    return hashlib.sha1(json.dumps([fingerprints, params], sort_keys=True).encode()).hexdigest()
+
+
+def _entry_file(manifest, source_file, atlas_name) -> Path:
+    name = hashlib.sha1(('%s|%s' % (Path(source_file).resolve(), atlas_name)).encode()).hexdigest()
+    return Path(manifest) / (name + '.json')
+
+
+def is_current(manifest, source_file, atlas_name, key) -> bool:
+    """True if the recorded extraction of source_file with atlas_name has key and its outputs still exist"""
+    entry_file = _entry_file(manifest, source_file, atlas_name)
+    try:
+        with entry_file.open() as fobj:
+            entry = json.load(fobj)
+    except (FileNotFoundError, ValueError):
+        return False
+    return entry.get('key') == key and all(os.path.exists(out_file) for out_file in entry.get('outputs', []))
+
+
+def record(manifest, source_file, atlas_name, key, outputs):
+    """Write the manifest entry of one extraction (atomically, workers never share an entry)"""
+    manifest = Path(manifest)
+    manifest.mkdir(parents=True, exist_ok=True)
+    entry = {
+        'source': str(Path(source_file).resolve()),
+        'atlas_name': atlas_name,
+        'key': key,
+        'outputs': [str(out_file) for out_file in outputs],
+    }
+    fd, tmp = tempfile.mkstemp(suffix='.json.part', dir=str(manifest))
+    with os.fdopen(fd, 'w') as fobj:
+        json.dump(entry, fobj, indent=2)
+    os.replace(tmp, str(_entry_file(manifest, source_file, atlas_name)))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Peak memory model of an extraction
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+
+The peak RSS of extracting one image is estimated from its header alone (shape, data type,
+scaling and compression) as
+
+    BASE_GB + source * decoded GB + working * float64 GB
+
+where decoded GB is the size of the volumes held in memory at once as nibabel returns them (the
+whole series, or one block of volumes when streaming) and float64 GB is the size of the same
+volumes as float64. An uncertainty map is read alongside the source and doubles both terms.
+The (source, working) coefficients depend on the code path the extraction takes, see
+MEMORY_MODELS. They were fitted on peak RSS measurements of ``atlasTransform-memory-report``,
+which prints the estimate of every run next to its measured peak so the model can be tuned.
+"""
+import os
+
+import nibabel
+import numpy
+
+BASE_GB = 0.3  # interpreter with nipype, nilearn and the memory-mapped atlas indices
+MEMORY_MARGIN = 1.15
+MEMORY_MODELS = {
+    # code path: (source, working) coefficients
+    'native': (0.85, 0.3),  # sparse label / sphere index, gathers the labelled voxels only
+    'nilearn_labels': (0.9, 0.3),  # NiftiLabelsMasker
+    'nilearn_spheres': (0.2, 1.25),  # NiftiSpheresMasker, smooths the whole series as float first
+}
+_HEADERS = {}
+
+
+def header_info(nifti) -> dict:
+    """
+    shape, affine, bytes per decoded value and compression of nifti, without reading its data
+    (each header is read once per process, until the file changes)
+    """
+    stat = os.stat(str(nifti))
+    key = (str(nifti), stat.st_size, stat.st_mtime_ns)
+    if key not in _HEADERS:
+        img = nibabel.load(str(nifti))
+        slope, inter = img.header.get_slope_inter()
+        scaled = slope not in (None, 1) or inter not in (None, 0)
+        _HEADERS[key] = dict(
+            shape=tuple(int(size) for size in img.shape),
+            affine=numpy.asarray(img.affine, dtype=numpy.float64),
+            itemsize=8 if scaled else img.header.get_data_dtype().itemsize,
+            compressed=str(nifti).endswith('.gz'),
+        )
+    return _HEADERS[key]
+
+
+def memory_model(atlas_name: str, engine: str, streamed: bool, with_uncertainty: bool,
+                 all_granularities: bool = False) -> str:
+    """The MEMORY_MODELS entry of the code path extracting atlas_name takes (see AtlasTransform._extractor)"""
+    if engine == 'native' or (atlas_name == 'craddock' and all_granularities):
+        return 'native'
+    if atlas_name == 'power':
+        return 'nilearn_spheres'
+    # uncertainty propagation and streamed blocks always use the label index
+    return 'native' if streamed or with_uncertainty else 'nilearn_labels'
+
+
+def estimate_mem_gb(nifti, atlas_names: list, engine: str = 'native', block_size: int = 0,
+                    with_uncertainty: bool = False, all_granularities: bool = False) -> float:
+    """
+    :param nifti: the source image (only its header is read)
+    :param atlas_names: atlases extracted from it, one after the other
+    :param engine: extraction engine
+    :param block_size: volumes per block when streaming 4D inputs (0 reads the whole series)
+    :param with_uncertainty: an uncertainty map is propagated along
+    :param all_granularities: every craddock cluster size is extracted at once
+    :return: estimated peak memory of the extraction in GB
+    """
+    info = header_info(nifti)
+    shape = info['shape']
+    n_volumes = shape[3] if len(shape) == 4 else 1
+    streamed = 0 < block_size < n_volumes
+    voxels = shape[0] * shape[1] * shape[2] * (block_size if streamed else n_volumes)
+    decoded_gb = voxels * info['itemsize'] / 1024 ** 3
+    float_gb = voxels * 8 / 1024 ** 3
+    if with_uncertainty:
+        decoded_gb, float_gb = 2 * decoded_gb, 2 * float_gb
+
+    peak_gb = 0.
+    for atlas_name in atlas_names:
+        model = memory_model(atlas_name, engine, streamed, with_uncertainty, all_granularities)
+        source, working = MEMORY_MODELS[model]
+        peak_gb = max(peak_gb, source * decoded_gb + working * float_gb)
+    return round(MEMORY_MARGIN * (BASE_GB + peak_gb), 2)
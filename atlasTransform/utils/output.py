@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Writers and readers for roi data
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+"""
+import numpy
+
+from .constants import OUTPUT_EXTENSIONS, OUTPUT_FORMATS, OUTPUT_PRECISIONS
+
+DATASET_NAME = 'roi_data'
+
+
+def write_roi_data(out_file: str, roi_data: numpy.ndarray, output_format: str = 'csv', precision: str = 'float64'):
+    """
+    :param out_file: path ending with OUTPUT_EXTENSIONS[output_format]
+    :param roi_data: (timepoints x rois) or (rois,) array
+    :param output_format: one of OUTPUT_FORMATS
+    :param precision: float64 or float32
+    """
+    if output_format not in OUTPUT_EXTENSIONS:
+        raise RuntimeError("%s is not a valid output format. Please use one of %s" % (output_format, str(OUTPUT_FORMATS)))
+    if precision not in OUTPUT_PRECISIONS:
+        raise RuntimeError("%s is not a valid precision. Please use one of %s" % (precision, str(OUTPUT_PRECISIONS)))
+    roi_data = numpy.asarray(roi_data, dtype=precision)
+
+    if output_format == 'csv':
+        numpy.savetxt(out_file, roi_data, delimiter=',', fmt='%.18e' if precision == 'float64' else '%.9g')
+    elif output_format == 'npy':
+        numpy.save(out_file, roi_data)
+    elif output_format == 'npz':
+        numpy.savez_compressed(out_file, **{DATASET_NAME: roi_data})
+    elif output_format == 'hdf5':
+        try:
+            import h5py
+        except ImportError:
+            raise RuntimeError("Writing hdf5 outputs requires h5py (pip install h5py)")
+        with h5py.File(out_file, 'w') as fobj:
+            fobj.create_dataset(DATASET_NAME, data=roi_data, chunks=True if roi_data.ndim > 1 else None)
+    else:
+        import pandas
+        roi_data = numpy.atleast_2d(roi_data)
+        try:
+            pandas.DataFrame(roi_data, columns=[str(i) for i in range(roi_data.shape[1])]).to_parquet(
+                out_file, index=False)
+        except ImportError:
+            raise RuntimeError("Writing parquet outputs requires pyarrow (pip install pyarrow)")
+
+
+def read_roi_data(in_file: str) -> numpy.ndarray:
+    """Read a file written by write_roi_data, the format is taken from the extension"""
+    in_file = str(in_file)
+    if in_file.endswith('.csv'):
+        return numpy.loadtxt(in_file, delimiter=',')
+    if in_file.endswith('.npy'):
+        return numpy.load(in_file)
+    if in_file.endswith('.npz'):
+        with numpy.load(in_file) as npz:
+            return npz[DATASET_NAME]
+    if in_file.endswith('.h5'):
+        import h5py
+        with h5py.File(in_file, 'r') as fobj:
+            return fobj[DATASET_NAME][()]
+    if in_file.endswith('.parquet'):
+        import pandas
+        return pandas.read_parquet(in_file).to_numpy()
+    raise RuntimeError("Unknown roi data format: %s" % in_file)
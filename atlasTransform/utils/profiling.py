@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Per-stage profiles of the extractions
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+
+A StageProfiler records, for every named stage of one extraction (atlas loading, reading and
+inflating the source, roi reduction, temporal filtering, writing), the wall time, the cpu time
+of the process, the bytes read (``rchar`` and ``read_bytes`` of /proc/self/io, where available)
+and how much the peak RSS of the process grew. Entering a stage several times (e.g. one read per
+streamed block) adds up. When profiling is off, NULL_PROFILER hands out one shared no-op
+context, so the instrumented code costs a method call per stage.
+
+With ``--profile summary`` every run also leaves a copy of its profile under
+``<output_dir>/atlasTransform/logs/profiles`` and ``summarize_profiles`` aggregates them at the
+end into ``profile_summary.json`` and ``profile_runs.tsv`` in the logs folder.
+"""
+import glob
+import hashlib
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+PROFILE_SUMMARY_FILE = 'profile_summary.json'
+PROFILE_RUNS_FILE = 'profile_runs.tsv'
+_METRICS = ['wall_s', 'cpu_s', 'read_chars', 'read_bytes', 'peak_rss_delta_mb']
+# ru_maxrss is in kilobytes on linux and in bytes on macOS
+_MAXRSS_MB = 1 / 1024 ** 2 if sys.platform == 'darwin' else 1 / 1024
+
+
+def profile_dir(output_dir) -> str:
+    """where the runs of an output directory leave their profiles for the summary"""
+    return str(Path(output_dir).resolve() / 'atlasTransform' / 'logs' / 'profiles')
+
+
+def _io_counters() -> dict:
+    try:
+        with open('/proc/self/io') as fobj:
+            counters = dict(line.split(':') for line in fobj)
+    except OSError:
+        return {}
+    return {'read_chars': int(counters['rchar']), 'read_bytes': int(counters['read_bytes'])}
+
+
+def _sample() -> dict:
+    sample = {'wall_s': time.perf_counter(), 'cpu_s': time.process_time(),
+              'peak_rss_delta_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _MAXRSS_MB}
+    sample.update(_io_counters())
+    return sample
+
+
+class StageProfiler(object):
+    """Wall time, cpu time, bytes read and peak RSS growth of the stages of one extraction"""
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self._start = _sample()
+
+    @contextmanager
+    def stage(self, name: str):
+        before = _sample()
+        try:
+            yield
+        finally:
+            after = _sample()
+            totals = self.stages.setdefault(name, dict.fromkeys(before, 0))
+            for metric in before:
+                totals[metric] += after[metric] - before[metric]
+
+    def report(self, **info) -> dict:
+        """info and the stage totals, with the whole extraction as 'total'"""
+        end = _sample()
+        report = dict(info)
+        report['total'] = {metric: end[metric] - self._start[metric] for metric in self._start}
+        report['stages'] = self.stages
+        return report
+
+
+class _NullProfiler(object):
+    _context = nullcontext()
+
+    def stage(self, name: str):
+        return self._context
+
+
+NULL_PROFILER = _NullProfiler()
+
+
+def write_profile(path, report: dict):
+    with open(str(path), 'w') as fobj:
+        json.dump(report, fobj, indent=2)
+
+
+def record_profile(profiles, report: dict):
+    """Leave a copy of the profile of one run for summarize_profiles"""
+    profiles = Path(profiles)
+    profiles.mkdir(parents=True, exist_ok=True)
+    name = hashlib.sha1(str(report['source']).encode()).hexdigest()
+    fd, tmp = tempfile.mkstemp(suffix='.json.part', dir=str(profiles))
+    with os.fdopen(fd, 'w') as fobj:
+        json.dump(report, fobj)
+    os.replace(tmp, str(profiles / (name + '.json')))
+
+
+def summarize_profiles(profiles) -> dict:
+    """
+    Aggregate the recorded profiles (the latest of every source) into <logs>/profile_summary.json
+    (totals, means and maxima of every stage) and <logs>/profile_runs.tsv (one row per run and
+    stage), <logs> being the parent of profiles.
+    :return: the summary
+    """
+    reports = []
+    for path in sorted(glob.glob(os.path.join(str(profiles), '*.json'))):
+        with open(path) as fobj:
+            reports.append(json.load(fobj))
+    summary = OrderedDict(runs=len(reports), stages=OrderedDict())
+    stage_names = sorted({name for report in reports for name in report['stages']})
+    for name in (['total'] + stage_names) if reports else []:
+        values = [report['total'] if name == 'total' else report['stages'][name]
+                  for report in reports if name == 'total' or name in report['stages']]
+        summary['stages'][name] = OrderedDict(
+            (metric, OrderedDict(sum=sum(value.get(metric, 0) for value in values),
+                                 mean=sum(value.get(metric, 0) for value in values) / len(values),
+                                 max=max(value.get(metric, 0) for value in values)))
+            for metric in _METRICS)
+
+    logs = Path(profiles).parent
+    logs.mkdir(parents=True, exist_ok=True)
+    write_profile(logs / PROFILE_SUMMARY_FILE, summary)
+    with (logs / PROFILE_RUNS_FILE).open('w') as fobj:
+        fobj.write('\t'.join(['source', 'stage'] + _METRICS) + '\n')
+        for report in reports:
+            for name, values in [('total', report['total'])] + list(report['stages'].items()):
+                fobj.write('\t'.join([report['source'], name] +
+                                     ['%.6g' % values.get(metric, 0) for metric in _METRICS]) + '\n')
+    return summary
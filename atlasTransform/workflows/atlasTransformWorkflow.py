@@ -1,44 +1,96 @@
+from pathlib import Path
+
+import nibabel
+import numpy
+
 from nipype.pipeline import engine as pe
 from nipype.interfaces import (
     utility as niu,
 )
 from niworkflows.engine.workflows import LiterateWorkflow as Workflow
-from ..interfaces import AtlasTransform
+from ..interfaces import AtlasTransform, AtlasTransformBatch
+from ..interfaces.atlasTransform import atlas_index, sphere_index, LOW_MEM_BLOCK_SIZE
+from ..utils.atlas import atlas_identity
+from ..utils.group_store import group_store_dir
+from ..utils.manifest import manifest_dir
+from ..utils.memory import estimate_mem_gb, header_info
+from ..utils.profiling import profile_dir
+from ..__about__ import __version__
 
 
-def init_atlas_transform_workflow(nifti, atlas_name, options, bids_dir,name='atlas_transform_wf'):
+def init_atlas_transform_workflow(nifti, atlas_name, options, bids_dir, uncertainty=None, manifest_keys=None,
+                                  estimate_memory=True, name='atlas_transform_wf'):
+    """
+    nifti can also be a list of niftis processed by one batched node (uncertainty and manifest_keys are then
+    lists with one entry per nifti)
+    :param estimate_memory: size the transform node from the input headers (off for placeholder inputs that do
+        not exist, the node then keeps nipype's default mem_gb)
+    """
 
     workflow = Workflow(name=name)
     desc = """Transformation to atlas space
     : """
 
     inputnode = pe.Node(
-        niu.IdentityInterface(fields=['nifti','atlas_name', 'resolution', 'number_of_clusters', 'similarity_measure', 'algorithm', 'bids_dir', 'subjects_dir']),
+        niu.IdentityInterface(fields=['nifti', 'uncertainty', 'atlas_name', 'resolution', 'number_of_clusters', 'similarity_measure', 'algorithm', 'all_granularities', 'sphere_radius', 'sphere_overlap', 'engine', 'block_size', 'low_mem', 'cache_dir', 'cache_size_gb', 'atlas_cache_dir', 'output_format', 'precision', 'group_store', 'write_files', 'manifest_dir', 'manifest_keys', 'profile', 'profile_dir', 'bids_dir', 'subjects_dir']),
         name='inputnode')
 
     inputnode.inputs.nifti = nifti
     inputnode.inputs.bids_dir = bids_dir
+    if isinstance(nifti, list):
+        if any(path is not None for path in uncertainty or []):
+            inputnode.inputs.uncertainty = uncertainty
+    elif uncertainty is not None:
+        inputnode.inputs.uncertainty = uncertainty
     inputnode.inputs.atlas_name = atlas_name
-    inputnode.inputs.resolution = options.resolution
-    inputnode.inputs.number_of_clusters = options.number_of_clusters
-    inputnode.inputs.similarity_measure = options.similarity_measure
-    inputnode.inputs.algorithm = options.algorithm
+    for field, value in interface_inputs(options).items():
+        setattr(inputnode.inputs, field, value)
+    if manifest_keys is not None:
+        inputnode.inputs.manifest_keys = manifest_keys
 
     outputnode = pe.Node(niu.IdentityInterface(
-        fields=['transformed']),
+        fields=['transformed', 'confidence_intervals', 'group_shard']),
         name='outputnode')
 
-    transformNode = pe.Node(AtlasTransform(), name='transform')
+    node_kwargs = {}
+    if estimate_memory and isinstance(nifti, list):
+        # the runs of a batch are transformed one after the other
+        node_kwargs['mem_gb'] = max(run_mem_gb(run_nifti, atlas_name, options, run_uncertainty)
+                                    for run_nifti, run_uncertainty in zip(nifti, uncertainty or [None] * len(nifti)))
+    elif estimate_memory:
+        node_kwargs['mem_gb'] = run_mem_gb(nifti, atlas_name, options, uncertainty)
+    transformNode = pe.Node(AtlasTransformBatch() if isinstance(nifti, list) else AtlasTransform(), name='transform',
+                            **node_kwargs)
 
     workflow.connect([
         (inputnode, transformNode, [('nifti', 'nifti')]),
+        (inputnode, transformNode, [('uncertainty', 'uncertainty')]),
         (inputnode, transformNode, [('bids_dir', 'bids_dir')]),
         (inputnode, transformNode, [('atlas_name', 'atlas_name')]),
         (inputnode, transformNode, [('resolution', 'resolution')]),
         (inputnode, transformNode, [('number_of_clusters', 'number_of_clusters')]),
         (inputnode, transformNode, [('similarity_measure', 'similarity_measure')]),
         (inputnode, transformNode, [('algorithm', 'algorithm')]),
+        (inputnode, transformNode, [('all_granularities', 'all_granularities')]),
+        (inputnode, transformNode, [('sphere_radius', 'sphere_radius')]),
+        (inputnode, transformNode, [('sphere_overlap', 'sphere_overlap')]),
+        (inputnode, transformNode, [('engine', 'engine')]),
+        (inputnode, transformNode, [('block_size', 'block_size')]),
+        (inputnode, transformNode, [('low_mem', 'low_mem')]),
+        (inputnode, transformNode, [('cache_dir', 'cache_dir')]),
+        (inputnode, transformNode, [('cache_size_gb', 'cache_size_gb')]),
+        (inputnode, transformNode, [('atlas_cache_dir', 'atlas_cache_dir')]),
+        (inputnode, transformNode, [('output_format', 'output_format')]),
+        (inputnode, transformNode, [('precision', 'precision')]),
+        (inputnode, transformNode, [('group_store', 'group_store')]),
+        (inputnode, transformNode, [('write_files', 'write_files')]),
+        (inputnode, transformNode, [('manifest_dir', 'manifest_dir')]),
+        (inputnode, transformNode, [('manifest_keys', 'manifest_keys')]),
+        (inputnode, transformNode, [('profile', 'profile')]),
+        (inputnode, transformNode, [('profile_dir', 'profile_dir')]),
         (transformNode, outputnode, [('transformed', 'transformed')]),
+        (transformNode, outputnode, [('confidence_intervals', 'confidence_intervals')]),
+        (transformNode, outputnode, [('group_shard', 'group_shard')]),
     ])
 
     # ds_report_summary = pe.Node(
@@ -62,3 +114,111 @@ def init_atlas_transform_workflow(nifti, atlas_name, options, bids_dir,name='atl
     #         ('outputnode.validation_report', 'in_file')]),
     # ])
     return workflow
+
+
+def interface_inputs(options) -> dict:
+    """AtlasTransform inputs that come from the command line options (the same for every run)"""
+    inputs = dict(
+        resolution=options.resolution,
+        number_of_clusters=options.number_of_clusters,
+        similarity_measure=options.similarity_measure,
+        algorithm=options.algorithm,
+        all_granularities=options.all_granularities,
+        sphere_overlap=options.sphere_overlap,
+        engine=options.extraction_engine,
+        block_size=options.block_size,
+        low_mem=options.low_mem,
+        output_format=options.output_format,
+        precision=options.output_precision,
+        write_files=options.group_store != 'only',
+        profile=options.profile is not None,
+        atlas_cache_dir=str(Path(options.work_dir).resolve() / 'atlas_cache'),
+    )
+    if options.sphere_radius is not None:
+        inputs['sphere_radius'] = options.sphere_radius
+    if options.group_store is not None:
+        inputs['group_store'] = group_store_dir(options.output_dir)
+    if options.incremental:
+        inputs['manifest_dir'] = manifest_dir(options.output_dir)
+    if options.profile == 'summary':
+        inputs['profile_dir'] = profile_dir(options.output_dir)
+    if options.bold_cache:
+        inputs['cache_dir'] = str(Path(options.work_dir).resolve() / 'bold_cache')
+        inputs['cache_size_gb'] = options.bold_cache_gb
+    return inputs
+
+
+def run_mem_gb(nifti, atlas_names, options, uncertainty=None) -> float:
+    """Estimated peak memory of transforming nifti, from its header (see utils.memory)"""
+    if not isinstance(atlas_names, list):
+        atlas_names = [atlas_names]
+    block_size = options.block_size or (LOW_MEM_BLOCK_SIZE if options.low_mem else 0)
+    return estimate_mem_gb(nifti, atlas_names, engine=options.extraction_engine, block_size=block_size,
+                           with_uncertainty=uncertainty is not None, all_granularities=options.all_granularities)
+
+
+def extraction_params(atlas_name, options) -> dict:
+    """Every option the roi data of atlas_name depend on, for the incremental rerun manifest"""
+    all_granularities = atlas_name == 'craddock' and options.all_granularities
+    params = dict(
+        atlas=atlas_identity(
+            atlas_name,
+            resolution=options.resolution,
+            number_of_clusters=None if all_granularities else options.number_of_clusters,
+            similarity_measure=options.similarity_measure,
+            algorithm=options.algorithm
+        ),
+        engine=options.extraction_engine,
+        output_format=options.output_format,
+        precision=options.output_precision,
+        group_store=options.group_store,
+        version=__version__,
+    )
+    if atlas_name == 'power':
+        params.update(sphere_radius=options.sphere_radius, sphere_overlap=options.sphere_overlap)
+    return params
+
+
+_PREPARED_ATLASES = set()
+
+
+def shared_index_atlases(atlas_names, options) -> list:
+    """
+    The atlas names the transform nodes extract through a memory-mapped index rather than a nilearn
+    masker (see AtlasTransform._extractor); only those are worth preparing
+    """
+    if options.extraction_engine == 'native':
+        return list(atlas_names)
+    # error propagation and streamed blocks use the label index with either engine
+    label_index = options.uncertainty_suffix is not None or bool(options.block_size) or options.low_mem
+    return [atlas_name for atlas_name in atlas_names if atlas_name != 'power' and (
+        label_index or (atlas_name == 'craddock' and options.all_granularities))]
+
+
+def prepare_shared_atlases(nifti, atlas_names, options):
+    """
+    Resample and index the label atlases (and the power spheres) for the grid of nifti in the process
+    building the workflow, so the workers attach to the memory-mapped copies in <work_dir>/atlas_cache
+    instead of each loading and resampling their own. Done once per grid and atlas: other runs only
+    cost the (cached) header lookup, and nothing is read when no atlas uses an index.
+    """
+    atlas_names = shared_index_atlases(atlas_names, options)
+    if not atlas_names:
+        return
+    info = header_info(nifti)
+    grid = (info['shape'][:3], numpy.round(info['affine'], 6).tobytes())
+    atlas_names = [atlas_name for atlas_name in atlas_names if (grid, atlas_name) not in _PREPARED_ATLASES]
+    if not atlas_names:
+        return
+    img = nibabel.load(nifti)
+    for atlas_name in atlas_names:
+        if atlas_name == 'power':
+            sphere_index(img, atlas_cache_dir=str(Path(options.work_dir).resolve() / 'atlas_cache'),
+                         radius=options.sphere_radius, overlap=options.sphere_overlap)
+            _PREPARED_ATLASES.add((grid, atlas_name))
+            continue
+        atlas_index(atlas_name, img, atlas_cache_dir=str(Path(options.work_dir).resolve() / 'atlas_cache'),
+                    resolution=options.resolution, number_of_clusters=options.number_of_clusters,
+                    similarity_measure=options.similarity_measure, algorithm=options.algorithm,
+                    all_granularities=options.all_granularities)
+        _PREPARED_ATLASES.add((grid, atlas_name))
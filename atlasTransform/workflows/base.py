@@ -3,29 +3,40 @@ from bids import BIDSLayout
 from nipype import Workflow
 import os
 from copy import deepcopy
+from pathlib import Path
 
 from nipype import __version__ as nipype_ver
+from nipype import logging
 from nipype.pipeline import engine as pe
 from nipype.interfaces import utility as niu
 
 from niworkflows.engine.workflows import LiterateWorkflow as Workflow
-from ..utils.bids import collect_data
+from ..utils.bids import collect_data, get_uncertainty_map
 
-from ..workflows.atlasTransformWorkflow import init_atlas_transform_workflow
+from ..utils.manifest import extraction_key, file_fingerprint, is_current, manifest_dir
+from ..workflows.atlasTransformWorkflow import (
+    extraction_params, init_atlas_transform_workflow, prepare_shared_atlases)
 
 from ..__about__ import __version__
 
+LOGGER = logging.getLogger('nipype.workflow')
+
 
 def init_base_wf(opts: ArgumentParser,
                  layout: BIDSLayout,
                  run_uuid: str,
                  subject_list: list,
                  work_dir: str,
-                 output_dir: str):
+                 output_dir: str,
+                 subject_data: dict = None):
+    """
+    :param subject_data: the collected inputs of every subject (collected from layout if None)
+    """
     workflow = Workflow(name='atlasTransform_wf')
     workflow.base_dir = opts.work_dir
 
     reportlets_dir = os.path.join(opts.work_dir, 'reportlets')
+    subject_wfs = []
     for subject_id in subject_list:
         single_subject_wf = init_single_subject_wf(
             opts=opts,
@@ -36,15 +47,24 @@ def init_base_wf(opts: ArgumentParser,
             name="single_subject_" + subject_id +"_wf",
             subject_id=subject_id,
             reportlets_dir=reportlets_dir,
+            subject_data=subject_data[subject_id] if subject_data is not None else None,
         )
+        if opts.incremental and not any(node.startswith('atlas_transform_')
+                                        for node in single_subject_wf.list_node_names()):
+            continue  # every run of the subject is up to date
 
         single_subject_wf.config['execution']['crashdump_dir'] = (
             os.path.join(output_dir, "atlasTransform", "sub-" + subject_id, 'log', run_uuid)
         )
+        # nodes only read their config, so they all share one copy per subject
+        subject_config = deepcopy(single_subject_wf.config)
         for node in single_subject_wf._get_all_nodes():
-            node.config = deepcopy(single_subject_wf.config)
+            node.config = subject_config
+
+        subject_wfs.append(single_subject_wf)
 
-        workflow.add_nodes([single_subject_wf])
+    # one add_nodes call, nipype checks the names of all nodes in the graph on every call
+    workflow.add_nodes(subject_wfs)
 
     return workflow
 
@@ -58,14 +78,16 @@ def init_single_subject_wf(
             name:str,
             subject_id:str,
             reportlets_dir:str,
+            subject_data: dict = None,
 ):
     import nilearn
-    if name in ('single_subject_wf', 'single_subject_test_wf'):
+    documentation = subject_data is None and name in ('single_subject_wf', 'single_subject_test_wf')
+    if documentation:
         # for documentation purposes
         subject_data = {
             'bold': ['/completely/made/up/path/sub-01_task-nback_bold.nii.gz']
         }
-    else:
+    elif subject_data is None:
         subject_data = collect_data(layout, subject_id, None)[0]
 
     workflow = Workflow(name=name)
@@ -87,7 +109,7 @@ def init_single_subject_wf(
     It is released under the [CC0]\
     (https://creativecommons.org/publicdomain/zero/1.0/) license.
     ### References
-    """.format(nilearn_ver=nilearn.version.__version__)
+    """.format(nilearn_ver=nilearn.__version__)
 
     inputnode = pe.Node(niu.IdentityInterface(fields=['subjects_dir']),
                         name='inputnode')
@@ -136,12 +158,24 @@ def init_single_subject_wf(
         if node.split('.')[-1].startswith('ds_'):
             workflow.get_node(node).interface.out_path_base = 'atlasTransform'
 
-    for i in range(len(subject_data[opts.source])):
+    bids_root = str(layout.root) if layout is not None else str(Path(opts.bids_dir).resolve())
+    batches = {}
+    for i, source, uncertainty, atlas_names, manifest_keys in iter_runs(opts, subject_data[opts.source], output_dir):
+        if not documentation:  # the placeholder inputs do not exist
+            prepare_shared_atlases(source, atlas_names, opts)
+        if opts.batch_runs > 0:
+            # runs that need the same atlases share a batched node
+            batches.setdefault(tuple(atlas_names), []).append(
+                (source, uncertainty, manifest_keys))
+            continue
         transform_wf = init_atlas_transform_workflow(
-            nifti=subject_data[opts.source][i],
-            atlas_name=opts.atlas_name,
+            nifti=source,
+            atlas_name=atlas_names,
             options=opts,
-            bids_dir=str(layout.root),
+            bids_dir=bids_root,
+            uncertainty=uncertainty,
+            manifest_keys=manifest_keys,
+            estimate_memory=not documentation,
             name='atlas_transform_%d_wf' % i
         )
         workflow.connect([
@@ -157,9 +191,52 @@ def init_single_subject_wf(
         #     ('outputnode.transformed', 'inputnode.transformed')
         # ])])
 
+    batch_index = 0
+    for atlas_names, runs in batches.items():
+        for start in range(0, len(runs), opts.batch_runs):
+            niftis, uncertainties, manifest_keys = zip(*runs[start:start + opts.batch_runs])
+            transform_wf = init_atlas_transform_workflow(
+                nifti=list(niftis),
+                atlas_name=list(atlas_names),
+                options=opts,
+                bids_dir=bids_root,
+                uncertainty=list(uncertainties),
+                manifest_keys=list(manifest_keys) if opts.incremental else None,
+                estimate_memory=not documentation,
+                name='atlas_transform_batch_%d_wf' % batch_index
+            )
+            workflow.connect([
+                (inputnode, transform_wf, [('subjects_dir', 'inputnode.subjects_dir')]),
+            ])
+            batch_index += 1
+
     return workflow
 
 
+def iter_runs(opts: ArgumentParser, sources: list, output_dir: str):
+    """
+    The runs of a subject that have work to do
+    :return: (index, source file, uncertainty map or None, atlas names to extract, manifest keys or None) per run
+    """
+    for i, source in enumerate(sources):
+        uncertainty = None
+        if opts.uncertainty_suffix is not None:
+            uncertainty = get_uncertainty_map(source, opts.uncertainty_suffix)
+        atlas_names = opts.atlas_name
+        manifest_keys = None
+        if opts.incremental:
+            fingerprints = [file_fingerprint(path, opts.fingerprint_samples)
+                            for path in [source, uncertainty] if path is not None]
+            manifest_keys = {atlas_name: extraction_key(fingerprints, extraction_params(atlas_name, opts))
+                             for atlas_name in atlas_names}
+            atlas_names = [atlas_name for atlas_name in atlas_names if not is_current(
+                manifest_dir(output_dir), source, atlas_name, manifest_keys[atlas_name])]
+            if not atlas_names:
+                LOGGER.info('Skipping %s, its outputs are up to date', source)
+                continue
+        yield i, source, uncertainty, atlas_names, manifest_keys
+
+
 def _prefix(subid):
     if subid.startswith('sub-'):
         return subid